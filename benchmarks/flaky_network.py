@@ -0,0 +1,148 @@
+"""
+Check the retries and resumed downloads of the API client against a local stand-in of the submission system with a
+flaky network, which runs without any services.
+
+For each download, the stand-in server drops the connection in the middle of the body, then answers 503, and then
+serves the rest of the file with a Range response. The downloads must pass the md5 check, and only the missing part
+must be sent again.
+
+Usage:
+    python benchmarks/flaky_network.py [--size 4194304]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FlakyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content: bytes):
+        super().__init__(('127.0.0.1', 0), FlakyHandler)
+        self.content = content
+        self.lock = threading.Lock()
+        self.requests = {}  # path -> number of requests so far
+        self.sent_bytes = 0
+        self.log = []
+
+    def next_attempt(self, path: str) -> int:
+        with self.lock:
+            attempt = self.requests.get(path, 0)
+            self.requests[path] = attempt + 1
+            return attempt
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        content = server.content
+        attempt = server.next_attempt(self.path)
+        range_header = self.headers.get('Range')
+        server.log.append((self.path, attempt, range_header))
+
+        if attempt == 0:
+            # send the headers of the whole file and half of the body, then drop the connection
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            half = len(content) // 2
+            self.wfile.write(content[:half])
+            server.sent_bytes += half
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        if attempt == 1:
+            # overloaded server
+            body = b'Service Unavailable'
+            self.send_response(503)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        offset = 0
+        match = re.fullmatch(r'bytes=(\d+)-', range_header or '')
+        if match:
+            offset = int(match.group(1))
+        if offset >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = content[offset:]
+        if offset:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.sent_bytes += len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check resumed downloads against a flaky stand-in server')
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='size (bytes) of the downloaded file')
+    args = parser.parse_args()
+
+    content = os.urandom(args.size)
+    md5 = hashlib.md5(content).hexdigest()
+    server = FlakyServer(content)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    work_folder = tempfile.mkdtemp(prefix='testbot-flaky-')
+    cwd = os.getcwd()
+    try:
+        # testbot.configs reads config.json from the working directory
+        with open(os.path.join(work_folder, 'config.json'), 'w') as f:
+            json.dump({
+                'SITE': {'root_url': 'http://127.0.0.1:%d' % server.server_address[1], 'base_url': '/'},
+                'DATA_FOLDER': os.path.join(work_folder, 'data'),
+                'AUTO_TEST': {'broker': 'memory://', 'backend': 'cache+memory://'},
+                'AUTO_TEST_WORKER': {'name': 'flaky', 'password': 'flaky'},
+                'API': {'timeout': 10, 'retries': 3, 'backoff': 0.1, 'max_backoff': 0.5}
+            }, f)
+        os.chdir(work_folder)
+        sys.path.insert(0, ROOT)
+        from testbot import api
+
+        path = api.download_material({'id': 1, 'md5': md5, 'name': 'env.zip'}, work_folder)
+        with open(os.path.join(work_folder, path), 'rb') as f:
+            assert f.read() == content, 'downloaded material does not match'
+
+        submission_file_path = os.path.join(work_folder, 'submission.bin')
+        api.download_submission_file(1, 'work', {'id': 2, 'md5': md5, 'requirement': {'name': 'submission.bin'}},
+                                     submission_file_path)
+        with open(submission_file_path, 'rb') as f:
+            assert f.read() == content, 'downloaded submission file does not match'
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+        server.shutdown()
+
+    for request_path, attempt, range_header in server.log:
+        print('%s attempt %d, Range: %s' % (request_path, attempt, range_header))
+    # each file is sent once in full plus the half before the dropped connection, if the download is resumed
+    print('Sent %d bytes for 2 files of %d bytes' % (server.sent_bytes, len(content)))
+    assert server.sent_bytes == 2 * len(content), 'downloads were not resumed'
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
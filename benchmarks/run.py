@@ -0,0 +1,261 @@
+"""
+Micro-benchmarks of the hot paths of the executors, which run locally without any services.
+
+Usage:
+    python benchmarks/run.py [--output benchmark-results.json] [--repeat 5] [--filter md5] [--large]
+
+The results are saved as JSON with the current git commit so that different commits can be compared.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_FRAMEWORK_FOLDER = os.path.join(ROOT, 'env_examples', 'docker', 'test')
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+
+class Runner:
+    def __init__(self, repeat: int, name_filter: str = None):
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = []
+
+    def enabled(self, name: str) -> bool:
+        return not self.name_filter or self.name_filter in name
+
+    def bench(self, name: str, func, setup=None, repeat: int = None, **params):
+        """
+        Time func for a number of rounds, where setup (if any) runs before each round and is not timed
+        """
+        if not self.enabled(name):
+            return
+        times = []
+        for _ in range(repeat or self.repeat):
+            arg = setup() if setup else None
+            time_start = time.perf_counter()
+            func(arg) if setup else func()
+            times.append(time.perf_counter() - time_start)
+        result = {
+            'name': name,
+            'params': params,
+            'rounds': len(times),
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times)
+        }
+        self.results.append(result)
+        print('%-40s %-40s min %.6fs median %.6fs' % (name, json.dumps(params), result['min'], result['median']))
+
+
+def _write_random_file(path: str, size: int):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 16 * MB)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def bench_md5sum(runner: Runner, work_folder: str, large: bool):
+    from testbot.util import md5sum
+
+    sizes = [KB, MB, 100 * MB] + ([GB] if large else [])
+    for size in sizes:
+        if not runner.enabled('md5sum'):
+            return
+        path = os.path.join(work_folder, 'md5-%d.bin' % size)
+        _write_random_file(path, size)
+        runner.bench('md5sum', lambda: md5sum(path), repeat=1 if size >= GB else None, size=size)
+        os.remove(path)
+
+
+def _make_log(size: int, tag_every: int, result_tag: str, error_tag: str) -> bytes:
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        if i % tag_every == 0:
+            line = '%s{"unit_%d": %d}' % (result_tag, i, i)
+        elif i % tag_every == 1:
+            line = '%s error in unit %d' % (error_tag, i)
+        else:
+            line = '2020-01-01 00:00:00,000 - test - INFO - Running test unit %d with some extra output' % i
+        lines.append(line)
+        total += len(line) + 1
+        i += 1
+    return '\n'.join(lines).encode()
+
+
+def bench_extract(runner: Runner):
+    from testbot.executors.env_test import EnvironmentTestExecutor
+
+    executor = EnvironmentTestExecutor.__new__(EnvironmentTestExecutor)  # no task or API needed
+    executor.result_tag = '##RESULT12345678##'
+    executor.error_tag = '##ERROR12345678##'
+    for tag_every in (10, 1000):
+        log = _make_log(10 * MB, tag_every, executor.result_tag, executor.error_tag)
+        runner.bench('extract_result', lambda: executor.extract_result(log), size=len(log), tag_every=tag_every)
+        runner.bench('extract_errors', lambda: executor.extract_errors(log), size=len(log), tag_every=tag_every)
+
+
+def _make_zip(path: str, num_files: int, file_size: int):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as f_zip:
+        for i in range(num_files):
+            # half random, half repeated content to get a realistic compression ratio
+            data = os.urandom(file_size // 2) + b'x' * (file_size - file_size // 2)
+            f_zip.writestr('env/data/%04d/file-%d.txt' % (i // 100, i), data)
+
+
+def bench_unpack(runner: Runner, work_folder: str):
+    def _zipfile_extract(src, dst):
+        with zipfile.ZipFile(src) as f_zip:
+            f_zip.extractall(dst)
+
+    methods = [
+        ('shutil.unpack_archive', shutil.unpack_archive),
+        ('zipfile.extractall', _zipfile_extract)
+    ]
+    if shutil.which('unzip'):
+        methods.append(('unzip', lambda src, dst: subprocess.run(['unzip', '-q', src, '-d', dst], check=True)))
+
+    for label, num_files, file_size in (('many-small', 5000, 2 * KB), ('few-large', 4, 25 * MB)):
+        if not runner.enabled('unpack'):
+            return
+        zip_path = os.path.join(work_folder, 'env-%s.zip' % label)
+        _make_zip(zip_path, num_files, file_size)
+        for method_name, method in methods:
+            runner.bench('unpack.%s' % method_name, lambda dst: method(zip_path, dst),
+                         setup=lambda: tempfile.mkdtemp(dir=work_folder), archive=label, files=num_files,
+                         file_size=file_size)
+        os.remove(zip_path)
+
+
+def bench_test_framework(runner: Runner, work_folder: str):
+    sys.path.insert(0, TEST_FRAMEWORK_FOLDER)
+    sys.path.insert(0, work_folder)
+    import test_framework
+    logging.getLogger(test_framework.__name__).setLevel(logging.WARNING)
+
+    for num_units in (100, 1000, 5000):
+        paths = ['Part%d.Question%d.Item%d' % (i % 10, (i // 10) % 10, i) for i in range(num_units)]
+
+        def _set_paths():
+            d = {}
+            for i, path in enumerate(paths):
+                test_framework.dict_set_path(d, path, i)
+
+        runner.bench('dict_set_path', _set_paths, units=num_units)
+
+        # a submission module with one method per unit
+        module_name = 'bench_submission_%d' % num_units
+        with open(os.path.join(work_folder, module_name + '.py'), 'w') as f:
+            for i in range(num_units):
+                f.write('def func_%d():\n    return %s\n' % (i, [i, {'a': 1, 'b': 2.5}, [1, 2, 'x']][i % 3]))
+
+        def _create_suite():
+            suite = test_framework.TestSuite({'submission': module_name})
+            for i in range(num_units):
+                def endpoint(method):
+                    return method()
+
+                endpoint = types.FunctionType(endpoint.__code__, endpoint.__globals__, 'test_%d' % i)
+                suite.add_unit(test_framework.TestUnit('test_%d' % i, endpoint, {'method': 'func_%d' % i},
+                                                       result_path=paths[i]))
+            return suite
+
+        def _run_suite(suite):
+            with contextlib.redirect_stdout(io.StringIO()):
+                suite.run()
+
+        runner.bench('TestSuite.add_unit', _create_suite, repeat=1 if num_units >= 5000 else None, units=num_units)
+        runner.bench('TestSuite.run', _run_suite, setup=_create_suite, repeat=1 if num_units >= 5000 else None,
+                     units=num_units)
+
+
+def bench_multipart(runner: Runner):
+    import requests
+
+    files = {
+        'stdout.txt': os.urandom(MB),
+        'stderr.txt': os.urandom(MB),
+        'docker-build-logs.jsonl': b'{"stream":"Step 1/10 : FROM ubuntu"}\n' * (10 * MB // 38),
+        'docker-run-logs.txt': os.urandom(10 * MB),
+        'summary.json': json.dumps({'unit_%d' % i: i for i in range(10000)})
+    }
+    runner.bench('upload_output_files.multipart',
+                 lambda: requests.Request('POST', 'http://localhost/', files=files).prepare(),
+                 files=len(files), size=sum(len(v) for v in files.values()))
+
+
+def _get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the executor hot paths')
+    parser.add_argument('--output', default='benchmark-results.json', help='file to save the results (JSON)')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds of each benchmark')
+    parser.add_argument('--filter', help='only run the benchmarks with this substring in the name')
+    parser.add_argument('--large', action='store_true', help='include the 1GB file for md5sum')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    random.seed(0)
+    runner = Runner(args.repeat, args.filter)
+    work_folder = tempfile.mkdtemp(prefix='testbot-bench-')
+    cwd = os.getcwd()
+    try:
+        # testbot.configs reads config.json from the working directory
+        with open(os.path.join(work_folder, 'config.json'), 'w') as f:
+            json.dump({
+                'SITE': {'root_url': 'http://localhost', 'base_url': '/'},
+                'DATA_FOLDER': os.path.join(work_folder, 'data'),
+                'AUTO_TEST': {'broker': 'memory://', 'backend': 'cache+memory://'},
+                'AUTO_TEST_WORKER': {'name': 'bench', 'password': 'bench'}
+            }, f)
+        os.chdir(work_folder)
+        sys.path.insert(0, ROOT)
+
+        bench_md5sum(runner, work_folder, args.large)
+        bench_extract(runner)
+        bench_unpack(runner, work_folder)
+        bench_test_framework(runner, work_folder)
+        bench_multipart(runner)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': _get_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': runner.results
+        }, f, indent=2)
+    print('Results saved to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
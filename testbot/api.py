@@ -1,86 +1,180 @@
+import fcntl
 import os
-import tempfile
+import random
+import time
 
 import requests
 
-from testbot.configs import worker_config, server_url
+from testbot.configs import config, worker_config, server_url
 from testbot.util import md5sum
 
+_api_config = config.get('API') or {}
+_TIMEOUT = _api_config.get('timeout', 60)  # seconds
+_RETRIES = _api_config.get('retries', 3)
+_BACKOFF = _api_config.get('backoff', 1)  # seconds
+_MAX_BACKOFF = _api_config.get('max_backoff', 30)  # seconds
+_TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
 
 class APIError(Exception):
     pass
 
 
+class TransientAPIError(APIError):
+    """
+    Error that may disappear if the request is tried again later, e.g. a dropped connection or an overloaded server
+    """
+    pass
+
+
 def get_auth_param():
     return worker_config['name'], worker_config['password']
 
 
+def _get_backoff(attempt: int) -> float:
+    """
+    Get the seconds to wait before the given retry of a request (also used by testbot.async_api)
+    """
+    delay = min(_BACKOFF * (2 ** attempt), _MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1)  # add jitter to avoid retrying at the same time
+
+
+def _check_response(resp: requests.Response):
+    if resp.status_code in _TRANSIENT_STATUS_CODES:
+        raise TransientAPIError('%d %s for url: %s' % (resp.status_code, resp.reason, resp.url))
+    resp.raise_for_status()
+
+
+def _with_retries(func):
+    """
+    Call func, retrying with exponential backoff on transient errors
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                TransientAPIError) as e:
+            if attempt >= _RETRIES:
+                if isinstance(e, TransientAPIError):
+                    raise
+                raise TransientAPIError(str(e)) from e
+        time.sleep(_get_backoff(attempt))
+        attempt += 1
+
+
+def _request(method: str, url: str, **kwargs) -> requests.Response:
+    def _do_request():
+        resp = requests.request(method, url, auth=get_auth_param(), timeout=_TIMEOUT, **kwargs)
+        _check_response(resp)
+        return resp
+
+    return _with_retries(_do_request)
+
+
+def _download(url: str, path: str, chunk_size: int):
+    """
+    Download a file, resuming from the existing content of the file with a Range request if possible
+    """
+
+    def _do_download():
+        offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        with requests.get(url, headers=headers, auth=get_auth_param(), timeout=_TIMEOUT, stream=True) as resp:
+            if offset and resp.status_code == 416:  # range not satisfiable, the file is already complete
+                return
+            _check_response(resp)
+            # the server may ignore the range and send the whole file
+            with open(path, 'ab' if offset and resp.status_code == 206 else 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+
+    _with_retries(_do_download)
+
+
+def _download_and_check(url: str, path: str, md5: str, chunk_size: int) -> bool:
+    """
+    Download a file with resuming and check its md5, starting over once if a resumed file is corrupted
+    :return: True if md5 check passed
+    """
+    resumed = os.path.isfile(path) and os.path.getsize(path) > 0
+    _download(url, path, chunk_size)
+    if md5sum(path) == md5:
+        return True
+    os.remove(path)
+    if not resumed:
+        return False
+    _download(url, path, chunk_size)
+    return md5sum(path) == md5
+
+
 def report_started(submission_id: int, work_id: str, hostname: str, pid: int):
     data = {'hostname': hostname, 'pid': pid}
-    resp = requests.put('%sapi/submissions/%d/worker-started/%s' % (server_url, submission_id, work_id),
-                        json=data, auth=get_auth_param())
-    resp.raise_for_status()
+    _request('PUT', '%sapi/submissions/%d/worker-started/%s' % (server_url, submission_id, work_id), json=data)
 
 
 def report_result(submission_id: int, work_id: str, data: dict):
-    resp = requests.put('%sapi/submissions/%d/worker-result/%s' % (server_url, submission_id, work_id),
-                        json=data, auth=get_auth_param())
-    resp.raise_for_status()
+    _request('PUT', '%sapi/submissions/%d/worker-result/%s' % (server_url, submission_id, work_id), json=data)
 
 
 def get_submission_and_config(submission_id: int, work_id: str):
-    resp = requests.get(
-        '%sapi/submissions/%d/worker-get-submission-and-config/%s' % (server_url, submission_id, work_id),
-        auth=get_auth_param())
-    resp.raise_for_status()
+    resp = _request('GET', '%sapi/submissions/%d/worker-get-submission-and-config/%s' %
+                    (server_url, submission_id, work_id))
     return resp.json()
 
 
-def download_material(material: dict, folder: str, chunk_size: int = 65536) -> str:
-    resp = requests.get('%sapi/materials/%d/worker-download' % (server_url, material['id']), auth=get_auth_param(),
-                        stream=True)
-    resp.raise_for_status()
-
-    name = material['name']
+def get_material_suffix(name: str):
     name_parts = name.rsplit('.', 2)
     if len(name_parts) > 1:
         name_parts[0] = ''
-        suffix = '.'.join(name_parts)
-    else:
-        suffix = None
-
-    ffd = None
-    try:
-        fd, path = tempfile.mkstemp(suffix=suffix, dir=folder)
-        ffd = os.fdopen(fd, 'wb')
-        for chunk in resp.iter_content(chunk_size=chunk_size):
-            if chunk:
-                ffd.write(chunk)
-    finally:
-        if ffd:
-            ffd.close()
-
-    if material['md5'] != md5sum(path):
-        raise APIError('MD5 check of material "%s" failed' % material['name'])
+        return '.'.join(name_parts)
+    return None
+
+
+def download_material(material: dict, folder: str, chunk_size: int = 65536, fetch=None) -> str:
+    """
+    Download a material into the folder unless it is already there
+    :param fetch: (optional) function `fetch(material, save_path) -> bool` to try first, e.g. to download from another
+    source. It is called under the same lock as the download.
+    :return: path of the material relative to the folder
+    """
+    name = 'material-%d-%s%s' % (material['id'], material['md5'], get_material_suffix(material['name']) or '')
+    path = os.path.join(folder, name)
+    part_path = path + '.part'
+
+    # the partial file is kept for resuming after a failure, and locked to avoid concurrent downloads
+    with open(part_path, 'ab') as f_lock:
+        fcntl.flock(f_lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isfile(path):  # may have been downloaded by another process
+                fetch_path = path + '.fetch'  # separate from the partial download, which can be resumed later
+                if fetch is not None and fetch(material, fetch_path):
+                    os.replace(fetch_path, path)
+                else:
+                    url = '%sapi/materials/%d/worker-download' % (server_url, material['id'])
+                    if not _download_and_check(url, part_path, material['md5'], chunk_size):
+                        raise APIError('MD5 check of material "%s" failed' % material['name'])
+                    os.replace(part_path, path)
+            else:
+                try:
+                    os.remove(part_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(f_lock, fcntl.LOCK_UN)
     return os.path.relpath(path, folder)
 
 
 def download_submission_file(submission_id: int, work_id: str, file: dict, local_save_path: str,
                              chunk_size: int = 65536):
-    resp = requests.get('%sapi/submissions/%d/worker-submission-files/%s/%d' %
-                        (server_url, submission_id, work_id, file['id']),
-                        auth=get_auth_param(), stream=True)
-    resp.raise_for_status()
-    with open(local_save_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=chunk_size):
-            if chunk:
-                f.write(chunk)
-    if file['md5'] != md5sum(local_save_path):
+    url = '%sapi/submissions/%d/worker-submission-files/%s/%d' % (server_url, submission_id, work_id, file['id'])
+    part_path = local_save_path + '.part'
+    if not _download_and_check(url, part_path, file['md5'], chunk_size):
         raise APIError('MD5 check of submission file "%s" failed' % file['requirement']['name'])
+    os.replace(part_path, local_save_path)
 
 
 def upload_output_files(submission_id: int, work_id: str, files: dict):
-    resp = requests.post('%sapi/submissions/%d/worker-output-files/%s' %
-                         (server_url, submission_id, work_id),
-                         files=files, auth=get_auth_param())
-    resp.raise_for_status()
+    _request('POST', '%sapi/submissions/%d/worker-output-files/%s' % (server_url, submission_id, work_id),
+             files=files)
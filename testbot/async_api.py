@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import aiohttp
+
+from testbot.api import _RETRIES, _TIMEOUT, _TRANSIENT_STATUS_CODES, APIError, TransientAPIError, _get_backoff, \
+    get_auth_param
+from testbot.configs import server_url
+
+_session = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    # one session (and connection pool) for the event loop of the worker process
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def request(method: str, url: str, auth: bool = True, **kwargs) -> str:
+    """
+    Send a request, retrying with exponential backoff on transient errors
+    :param method: HTTP method
+    :param url: URL
+    :param auth: whether to use the worker credentials
+    :param kwargs: other arguments for aiohttp
+    :return: response body as text
+    """
+    if auth:
+        kwargs['auth'] = aiohttp.BasicAuth(*get_auth_param())
+    attempt = 0
+    while True:
+        try:
+            async with _get_session().request(method, url, **kwargs) as resp:
+                if resp.status in _TRANSIENT_STATUS_CODES:
+                    raise TransientAPIError('%d %s for url: %s' % (resp.status, resp.reason, resp.url))
+                if resp.status >= 400:
+                    raise APIError('%d %s for url: %s' % (resp.status, resp.reason, resp.url))
+                return await resp.text()
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+                TransientAPIError) as e:
+            if attempt >= _RETRIES:
+                if isinstance(e, TransientAPIError):
+                    raise
+                raise TransientAPIError(str(e) or type(e).__name__) from e
+        await asyncio.sleep(_get_backoff(attempt))
+        attempt += 1
+
+
+async def report_started(submission_id: int, work_id: str, hostname: str, pid: int):
+    data = {'hostname': hostname, 'pid': pid}
+    await request('PUT', '%sapi/submissions/%d/worker-started/%s' % (server_url, submission_id, work_id), json=data)
+
+
+async def report_result(submission_id: int, work_id: str, data: dict):
+    await request('PUT', '%sapi/submissions/%d/worker-result/%s' % (server_url, submission_id, work_id), json=data)
+
+
+async def get_submission_and_config(submission_id: int, work_id: str):
+    text = await request('GET', '%sapi/submissions/%d/worker-get-submission-and-config/%s' %
+                         (server_url, submission_id, work_id))
+    return json.loads(text)
+
+
+async def upload_output_files(submission_id: int, work_id: str, files: dict):
+    # same multipart layout as requests, i.e. each file is a field with the same name as its file name
+    data = aiohttp.FormData()
+    for name, content in files.items():
+        data.add_field(name, content, filename=name)
+    await request('POST', '%sapi/submissions/%d/worker-output-files/%s' % (server_url, submission_id, work_id),
+                  data=data)
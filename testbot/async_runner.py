@@ -0,0 +1,63 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from testbot.configs import config
+
+_loop = None
+_slots = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def _get_loop():
+    """
+    Get the event loop of the current process, which runs in a background thread and is shared by all the task
+    threads
+    """
+    global _loop, _slots
+    with _lock:
+        if _loop is None:
+            async_config = config.get('ASYNC_WORKER') or {}
+            _slots = threading.BoundedSemaphore(async_config.get('max_in_flight', 100))
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='async-executors', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def _on_done(future):
+    with _lock:
+        _pending.discard(future)
+    _slots.release()
+
+
+def submit(coro) -> concurrent.futures.Future:
+    """
+    Hand a coroutine to the shared event loop without waiting for it. The calling thread only blocks while
+    `max_in_flight` coroutines are already running.
+    :return: future of the result of the coroutine
+    """
+    loop = _get_loop()
+    _slots.acquire()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(_on_done)
+    return future
+
+
+def shutdown(coro=None):
+    """
+    Wait for the running coroutines, and stop the shared event loop after running an optional clean-up coroutine
+    """
+    global _loop
+    with _lock:
+        loop, _loop = _loop, None
+        pending = list(_pending)
+    if loop is None:
+        return
+    concurrent.futures.wait(pending)
+    if coro is not None:
+        asyncio.run_coroutine_threadsafe(coro, loop).result()
+    loop.call_soon_threadsafe(loop.stop)
@@ -1,24 +1,59 @@
+import importlib
+import logging
 import ssl
+import time
 
 import celery
+from celery.signals import celeryd_after_setup, worker_process_init, worker_process_shutdown, worker_ready, \
+    worker_shutdown
 
-from testbot.configs import celery_config
-from testbot.executors.anti_plagiarism import AntiPlagiarismExecutor
-from testbot.executors.env_test_docker import DockerEnvironmentTestExecutor
-from testbot.executors.env_test_script import ScriptEnvironmentTestExecutor
-from testbot.executors.file_exists import FileExistsExecutor
-from testbot.task import BotTask
+from testbot import scheduling
+from testbot.configs import celery_config, config
+from testbot.task import AsyncBotTask, BatchBotTask, BotTask, get_retry_policy
+
+logger = logging.getLogger(__name__)
+
+# executors are imported lazily so that a worker only loads the dependencies (e.g. docker) of the queues it consumes
+_queue_executor_modules = {
+    'testbot_env_test_script': 'testbot.executors.env_test_script',
+    'testbot_env_test_docker': 'testbot.executors.env_test_docker',
+    'testbot_anti_plagiarism': 'testbot.executors.anti_plagiarism',
+    'testbot_meta': 'testbot.executors.file_exists'
+}
+_consumed_queues = set()
+_async_executors = bool((config.get('ASYNC_WORKER') or {}).get('enabled'))
+if _async_executors:
+    # light executors run their I/O in a shared event loop instead
+    _queue_executor_modules['testbot_anti_plagiarism'] = 'testbot.executors.async_executors'
+    _queue_executor_modules['testbot_meta'] = 'testbot.executors.async_executors'
+# with async executors, the results of the light tasks are reported by the executors when they finish
+_light_task_base = AsyncBotTask if _async_executors else BotTask
+
+_task_queues = {
+    'testbot.bot.run_env_test_script': 'testbot_env_test_script',
+    'testbot.bot.run_env_test_docker': 'testbot_env_test_docker',
+    'testbot.bot.run_anti_plagiarism': 'testbot_anti_plagiarism',
+    'testbot.bot.run_file_exists': 'testbot_meta',
+    'testbot.bot.run_env_test_script_batch': 'testbot_env_test_script',
+    'testbot.bot.run_env_test_docker_batch': 'testbot_env_test_docker'
+}
 
 app = celery.Celery('submit', broker=celery_config['broker'], backend=celery_config['backend'])
 app.conf.update(
-    task_routes={
-        'testbot.bot.run_env_test_script': {'queue': 'testbot_env_test_script'},
-        'testbot.bot.run_env_test_docker': {'queue': 'testbot_env_test_docker'},
-        'testbot.bot.run_anti_plagiarism': {'queue': 'testbot_anti_plagiarism'},
-        'testbot.bot.run_file_exists': {'queue': 'testbot_meta'}
-    },
-    task_track_started=True
+    task_routes={name: {'queue': queue} for name, queue in _task_queues.items()},
+    task_track_started=True,
+    # results are reported to the submission system anyway, storing them in the backend is optional
+    task_ignore_result=not (config.get('RESULT') or {}).get('store_return_value', True)
 )
+if scheduling.enabled:
+    app.conf.update(
+        task_queues=scheduling.get_task_queues(_task_queues.values()),
+        # acknowledge a task only after it finishes, so with the prefetch multiplier of 1 each pool process reserves
+        # only the task it is running, and no task waits behind a long container. A task is delivered again if the
+        # worker is lost while running it.
+        task_acks_late=True,
+        worker_prefetch_multiplier=1
+    )
 broker_ssl_config = celery_config.get('broker_use_ssl')
 if broker_ssl_config:
     cert_reqs = broker_ssl_config.get('cert_reqs')
@@ -33,30 +68,164 @@ if redis_ssl_config:
     app.conf.update(redis_backend_use_ssl=redis_ssl_config)
 
 
+@celeryd_after_setup.connect
+def preload_executors(instance, **_):
+    """
+    Import the executors of the consumed queues in the main process (before the pool processes are forked) and check
+    the import time against the budget
+    """
+    _consumed_queues.update(scheduling.get_base_queue(queue) for queue in instance.app.amqp.queues.consume_from)
+
+    time_start = time.perf_counter()
+    for queue in sorted(_consumed_queues):
+        module = _queue_executor_modules.get(queue)
+        if module:
+            importlib.import_module(module)
+    import_time = time.perf_counter() - time_start
+
+    startup_config = config.get('WORKER_STARTUP') or {}
+    budget = startup_config.get('import_time_budget', 2.0)  # seconds
+    if import_time > budget:
+        logger.warning('Importing executors took %.3fs, exceeding the budget of %.3fs', import_time, budget)
+    else:
+        logger.info('Importing executors took %.3fs', import_time)
+
+
+@worker_process_init.connect
+def init_docker_client(**_):
+    # create the Docker client in each pool process, since it is not safe to share the connections across fork
+    if 'testbot_env_test_docker' in _consumed_queues:
+        from testbot.executors.env_test_docker import DockerEnvironmentTestExecutor
+        DockerEnvironmentTestExecutor.get_docker_client()
+
+
+_docker_gc = None
+_env_cache_server = None
+
+
+@worker_ready.connect
+def start_docker_gc(**_):
+    global _docker_gc
+    # only the workers of the Docker queue use Docker
+    if 'testbot_env_test_docker' not in _consumed_queues:
+        return
+    from testbot import docker_gc
+    _docker_gc = docker_gc.create_from_config()
+    if _docker_gc is not None:
+        _docker_gc.start()
+
+
+@worker_ready.connect
+def start_env_cache_server(**_):
+    global _env_cache_server
+    from testbot import env_cache_peers
+    _env_cache_server = env_cache_peers.create_server_from_config()
+    if _env_cache_server is not None:
+        _env_cache_server.start()
+
+
+@worker_shutdown.connect
+def stop_docker_gc(**_):
+    if _docker_gc is not None:
+        _docker_gc.stop()
+
+
+@worker_shutdown.connect
+def stop_env_cache_server(**_):
+    if _env_cache_server is not None:
+        _env_cache_server.stop()
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def stop_async_executors(**_):
+    # the event loop runs in the process of the task, i.e. the main process with the threads or solo pool, and each
+    # pool process with the prefork pool, where only worker_process_shutdown is sent
+    if _async_executors:
+        from testbot import async_api, async_runner
+        async_runner.shutdown(async_api.close_session())
+
+
+def _start_with_retries(task: BotTask, executor):
+    """
+    Start the executor, and retry the task later if it fails due to a transient API error
+    """
+    from testbot.api import TransientAPIError
+    try:
+        return executor.start()
+    except TransientAPIError as e:
+        max_retries, countdown = get_retry_policy(task.request.retries)
+        raise task.retry(exc=e, countdown=countdown, max_retries=max_retries)
+
+
 @app.task(bind=True, base=BotTask, name='testbot.bot.run_env_test_script')
 def run_env_test_script(self: BotTask, submission_id: int, test_config_id: int):
-    return ScriptEnvironmentTestExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id).start()
+    from testbot.executors.env_test_script import ScriptEnvironmentTestExecutor
+    executor = ScriptEnvironmentTestExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id)
+    return _start_with_retries(self, executor)
 
 
 @app.task(bind=True, base=BotTask, name='testbot.bot.run_env_test_docker')
 def run_env_test_docker(self: BotTask, submission_id: int, test_config_id: int):
-    return DockerEnvironmentTestExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id).start()
+    from testbot.executors.env_test_docker import DockerEnvironmentTestExecutor
+    executor = DockerEnvironmentTestExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id)
+    return _start_with_retries(self, executor)
 
 
-@app.task(bind=True, base=BotTask, name='testbot.bot.run_anti_plagiarism')
+@app.task(bind=True, base=_light_task_base, name='testbot.bot.run_anti_plagiarism')
 def run_anti_plagiarism(self: BotTask, submission_id: int, test_config_id: int):
-    return AntiPlagiarismExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id).start()
+    if _async_executors:
+        from testbot.executors.async_executors import AsyncAntiPlagiarismExecutor
+        return AsyncAntiPlagiarismExecutor(task=self, submission_id=submission_id,
+                                           test_config_id=test_config_id).dispatch()
+    from testbot.executors.anti_plagiarism import AntiPlagiarismExecutor
+    executor = AntiPlagiarismExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id)
+    return _start_with_retries(self, executor)
 
 
-@app.task(bind=True, base=BotTask, name='testbot.bot.run_file_exists')
+@app.task(bind=True, base=_light_task_base, name='testbot.bot.run_file_exists')
 def run_file_exists(self: BotTask, submission_id: int, test_config_id: int):
-    return FileExistsExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id).start()
+    if _async_executors:
+        from testbot.executors.async_executors import AsyncFileExistsExecutor
+        return AsyncFileExistsExecutor(task=self, submission_id=submission_id,
+                                       test_config_id=test_config_id).dispatch()
+    from testbot.executors.file_exists import FileExistsExecutor
+    executor = FileExistsExecutor(task=self, submission_id=submission_id, test_config_id=test_config_id)
+    return _start_with_retries(self, executor)
+
+
+# batch tasks may run for hours, so they are acknowledged when received instead of holding an unacknowledged message
+# until the broker times out and delivers it again
+@app.task(bind=True, base=BatchBotTask, name='testbot.bot.run_env_test_script_batch', acks_late=False)
+def run_env_test_script_batch(self: BatchBotTask, test_config_id: int, submission_ids: list, work_ids: list = None,
+                              parallelism: int = None):
+    from testbot.executors.batch import BatchEnvironmentTestRunner
+    from testbot.executors.env_test_script import ScriptEnvironmentTestExecutor
+    return BatchEnvironmentTestRunner(task=self, executor_class=ScriptEnvironmentTestExecutor,
+                                      test_config_id=test_config_id, submission_ids=submission_ids,
+                                      work_ids=work_ids, parallelism=parallelism).start()
+
+
+@app.task(bind=True, base=BatchBotTask, name='testbot.bot.run_env_test_docker_batch', acks_late=False)
+def run_env_test_docker_batch(self: BatchBotTask, test_config_id: int, submission_ids: list, work_ids: list = None,
+                              parallelism: int = None):
+    from testbot.executors.batch import BatchEnvironmentTestRunner
+    from testbot.executors.env_test_docker import DockerEnvironmentTestExecutor
+    return BatchEnvironmentTestRunner(task=self, executor_class=DockerEnvironmentTestExecutor,
+                                      test_config_id=test_config_id, submission_ids=submission_ids,
+                                      work_ids=work_ids, parallelism=parallelism).start()
 
 
 # helper utilities for master server
 task_entries = {
-    'run-script': run_env_test_script,
-    'docker': run_env_test_docker,
-    'anti-plagiarism': run_anti_plagiarism,
-    'file-exists': run_file_exists
+    config_type: scheduling.TaskEntry(task, _task_queues[task.name])
+    for config_type, task in (('run-script', run_env_test_script),
+                              ('docker', run_env_test_docker),
+                              ('anti-plagiarism', run_anti_plagiarism),
+                              ('file-exists', run_file_exists))
+}
+batch_task_entries = {
+    config_type: scheduling.BatchTaskEntry(task, _task_queues[task.name])
+    for config_type, task in (('run-script', run_env_test_script_batch),
+                              ('docker', run_env_test_docker_batch))
 }
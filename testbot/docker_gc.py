@@ -0,0 +1,223 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import docker
+
+from testbot.configs import config, data_folder
+
+logger = logging.getLogger(__name__)
+
+# labels attached to the images and containers created by the testbot
+LABEL_TESTBOT = 'testbot'
+LABEL_TASK = 'testbot.task'
+LABEL_ENVIRONMENT = 'testbot.environment'
+
+
+def get_labels(task_id: str, environment_id: int) -> dict:
+    return {
+        LABEL_TESTBOT: 'true',
+        LABEL_TASK: task_id,
+        LABEL_ENVIRONMENT: str(environment_id)
+    }
+
+
+class DockerGarbageCollector:
+    """
+    Periodically remove the images and containers created by the testbot (found by labels) according to their age and
+    a total size budget. The latest images of the most recently used environments are kept to preserve the build cache.
+
+    The size of an image is its unique size, i.e. without the layers shared with other images, since only those are
+    freed by removing it. The reclaimed bytes are measured by the disk usage of the image layers before and after
+    the run.
+
+    The workers of a node share the Docker daemon, so each run takes a lock on `docker-gc.lock` in the data folder and
+    is skipped if another worker is collecting. The statistics in `docker-gc.json` are shared by them as well.
+    """
+
+    def __init__(self, interval: int = 600, max_age: int = 24, max_size: int = 20, keep_environments: int = 10,
+                 prune_build_cache: bool = True, prune_host_build_cache: bool = False):
+        """
+        :param interval: seconds between two runs
+        :param max_age: hours to keep an image or a stopped container
+        :param max_size: GB of total size budget of all the testbot images
+        :param keep_environments: number of the most recently used environments to keep the latest image for
+        :param prune_build_cache: whether to prune the dangling testbot images as well
+        :param prune_host_build_cache: whether to prune the build cache of the whole host, which is not labeled and may
+        be used by others
+        """
+        self.interval = interval
+        self.max_age = max_age * 3600
+        self.max_size = max_size * 1024 * 1024 * 1024
+        self.keep_environments = keep_environments
+        self.prune_build_cache = prune_build_cache
+        self.prune_host_build_cache = prune_host_build_cache
+
+        self.docker_client = None
+        self.stats_path = os.path.join(data_folder, 'docker-gc.json')
+        self.lock_path = os.path.join(data_folder, 'docker-gc.lock')
+        self.stats = {
+            'runs': 0,
+            'removed_images': 0,
+            'removed_containers': 0,
+            'reclaimed_bytes': 0,
+            'last_run': None,
+            'last_reclaimed_bytes': 0
+        }
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='docker-gc', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Docker garbage collection failed')
+            self._stopped.wait(self.interval)
+
+    def collect(self) -> int:
+        """
+        Run garbage collection once, unless another worker of the node is running it
+        :return: reclaimed bytes
+        """
+        with open(self.lock_path, 'a') as f_lock:
+            try:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug('Docker garbage collection is running in another worker')
+                return 0
+            try:
+                return self._collect()
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _collect(self) -> int:
+        self._load_stats()  # the other workers may have updated the statistics
+        if self.docker_client is None:
+            self.docker_client = docker.from_env()
+        now = time.time()
+
+        reclaimed = self._collect_containers(now)
+        disk_usage = self.docker_client.api.df()
+        layers_size = disk_usage.get('LayersSize') or 0
+        self._collect_images(now, disk_usage.get('Images') or [])
+        if self.prune_build_cache:
+            self._prune_images()
+        if self.prune_host_build_cache:
+            reclaimed += self._prune_builds()
+        reclaimed += max(layers_size - (self.docker_client.api.df().get('LayersSize') or 0), 0)
+
+        self.stats['runs'] += 1
+        self.stats['reclaimed_bytes'] += reclaimed
+        self.stats['last_run'] = now
+        self.stats['last_reclaimed_bytes'] = reclaimed
+        self._save_stats()
+        logger.info('Docker garbage collection reclaimed %d bytes', reclaimed)
+        return reclaimed
+
+    def _collect_containers(self, now: float) -> int:
+        reclaimed = 0
+        # the low-level API returns the size of the writable layer only if requested
+        containers = self.docker_client.api.containers(all=True, size=True, filters={
+            'label': LABEL_TESTBOT,
+            'status': ['created', 'exited', 'dead']
+        })
+        for container in containers:
+            if now - container['Created'] < self.max_age:
+                continue
+            try:
+                self.docker_client.api.remove_container(container['Id'], v=True)
+            except docker.errors.APIError as e:
+                logger.warning('Failed to remove container %s: %s', container['Id'], e)
+                continue
+            self.stats['removed_containers'] += 1
+            reclaimed += container.get('SizeRw') or 0
+        return reclaimed
+
+    @staticmethod
+    def _get_unique_size(image: dict) -> int:
+        # SharedSize is -1 if it is not calculated
+        return max((image.get('Size') or 0) - max(image.get('SharedSize') or 0, 0), 0)
+
+    def _collect_images(self, now: float, all_images: list):
+        """
+        :param all_images: images from the disk usage (`docker system df`), which come with their shared size
+        """
+        images = [image for image in all_images if LABEL_TESTBOT in (image.get('Labels') or {})]
+        images.sort(key=lambda x: x['Created'], reverse=True)  # most recent first
+
+        # keep the latest image for each of the most recently used environments
+        kept_environments = set()
+        protected = set()
+        for image in images:
+            env_id = image['Labels'].get(LABEL_ENVIRONMENT)
+            if env_id is None or env_id in kept_environments:
+                continue
+            if len(kept_environments) >= self.keep_environments:
+                break
+            kept_environments.add(env_id)
+            protected.add(image['Id'])
+
+        # remove expired images, then the oldest ones until the total size is within the budget
+        total_size = sum(self._get_unique_size(image) for image in images)
+        for image in reversed(images):
+            if image['Id'] in protected:
+                continue
+            if now - image['Created'] < self.max_age and total_size <= self.max_size:
+                continue
+            try:
+                self.docker_client.images.remove(image['Id'], force=False)
+            except docker.errors.APIError as e:
+                # image may be used by a running container
+                logger.warning('Failed to remove image %s: %s', image['Id'], e)
+                continue
+            self.stats['removed_images'] += 1
+            total_size -= self._get_unique_size(image)
+
+    def _prune_images(self):
+        try:
+            self.docker_client.images.prune(filters={'dangling': True, 'label': LABEL_TESTBOT})
+        except docker.errors.APIError as e:
+            logger.warning('Failed to prune dangling images: %s', e)
+
+    def _prune_builds(self) -> int:
+        try:
+            result = self.docker_client.api.prune_builds()
+            return result.get('SpaceReclaimed') or 0
+        except docker.errors.APIError as e:
+            logger.warning('Failed to prune build cache: %s', e)
+            return 0
+
+    def _load_stats(self):
+        try:
+            with open(self.stats_path) as f:
+                stats = json.load(f)
+        except (OSError, TypeError, ValueError):
+            return
+        if isinstance(stats, dict):
+            self.stats.update((k, v) for k, v in stats.items() if k in self.stats)
+
+    def _save_stats(self):
+        tmp_path = self.stats_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stats, f)
+        os.replace(tmp_path, self.stats_path)
+
+
+def create_from_config():
+    gc_config = config.get('DOCKER_GC')
+    if not gc_config:
+        return None
+    return DockerGarbageCollector(**gc_config)
@@ -0,0 +1,193 @@
+import fcntl
+import glob
+import hmac
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from testbot.configs import config, data_folder
+from testbot.util import md5sum
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = 'X-Testbot-Token'
+
+
+def get_peers_config() -> dict:
+    return config.get('ENV_CACHE_PEERS') or {}
+
+
+def find_cached_environment(env_folder: str, md5: str):
+    """
+    Find the cached environment zip with the given md5 from the meta files in the environment folder
+    :return: absolute path of the zip, or None if not found
+    """
+    for meta_path in glob.glob(os.path.join(env_folder, '*.json')):
+        try:
+            with open(meta_path) as f_meta:
+                env_meta = json.load(f_meta)
+            if env_meta['md5'] != md5:
+                continue
+            path = os.path.join(env_folder, env_meta['path'])
+        except (OSError, TypeError, ValueError, KeyError):
+            continue
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+class _EnvCacheRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'TestbotEnvCache/1.0'
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def _handle(self, send_body: bool):
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), token):
+            self.send_error(403)
+            return
+
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'environments' or not parts[1].isalnum():
+            self.send_error(404)
+            return
+        path = find_cached_environment(self.server.env_folder, parts[1])
+        if path is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        if send_body:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class EnvCacheServer:
+    """
+    Small HTTP server that lets the other worker nodes download the cached environments of this node by md5, i.e.
+    `GET /environments/<md5>`
+
+    The workers of a node share the environment folder and the port, so the server takes a lock on
+    `env-cache-server.lock` in the data folder before binding the port. The other workers keep waiting for the lock in
+    the background, and one of them takes over if the serving worker stops.
+    """
+    _LOCK_INTERVAL = 10  # seconds between two attempts to take the lock
+
+    def __init__(self, env_folder: str, host: str = '0.0.0.0', port: int = 7431, token: str = None):
+        self.env_folder = env_folder
+        self.address = (host, port)
+        self.token = token
+        self.lock_path = os.path.join(data_folder, 'env-cache-server.lock')
+        self.httpd = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._serve, name='env-cache-server', daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        with open(self.lock_path, 'a') as f_lock:
+            while True:
+                try:
+                    fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:  # served by another worker of this node
+                    if self._stopped.wait(self._LOCK_INTERVAL):
+                        return
+            try:
+                with self._lock:
+                    if self._stopped.is_set():
+                        return
+                    try:
+                        httpd = ThreadingHTTPServer(self.address, _EnvCacheRequestHandler)
+                    except OSError:
+                        logger.exception('Failed to start environment cache server on %s:%d', *self.address)
+                        return
+                    httpd.daemon_threads = True
+                    httpd.env_folder = self.env_folder
+                    httpd.token = self.token
+                    self.httpd = httpd
+                logger.info('Serving cached environments on %s:%d', *self.address)
+                httpd.serve_forever()
+                httpd.server_close()
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+            if self.httpd is not None:
+                self.httpd.shutdown()
+
+
+def create_server_from_config():
+    peers_config = get_peers_config()
+    listen = peers_config.get('listen')
+    if not listen:
+        return None
+    host, port = listen.rsplit(':', 1)
+    return EnvCacheServer(os.path.join(data_folder, 'test_environments'), host, int(port), peers_config.get('token'))
+
+
+def fetch_from_peers(material: dict, save_path: str, chunk_size: int = 65536) -> bool:
+    """
+    Try to download an environment from the peers in random order. The file is removed if no peer provides a valid
+    copy.
+    :param material: material info of the environment
+    :param save_path: path to save the environment
+    :param chunk_size: chunk size for downloading
+    :return: True if the environment is downloaded from a peer
+    """
+    peers_config = get_peers_config()
+    peers = list(peers_config.get('peers') or [])
+    if not peers:
+        return False
+    random.shuffle(peers)  # spread the load over the peers
+    timeout = peers_config.get('timeout', 3)
+    headers = {}
+    token = peers_config.get('token')
+    if token:
+        headers[TOKEN_HEADER] = token
+
+    for peer in peers:
+        url = '%s/environments/%s' % (peer.rstrip('/'), material['md5'])
+        try:
+            with open(save_path, 'wb') as f:
+                with requests.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+                    if resp.status_code != 200:
+                        raise requests.HTTPError('status %d' % resp.status_code)
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+            if md5sum(save_path) != material['md5']:
+                raise ValueError('MD5 check failed')
+        except (requests.RequestException, OSError, ValueError) as e:
+            logger.info('Failed to fetch environment %s from peer %s: %s', material['md5'], peer, e)
+            continue
+        logger.info('Fetched environment %s from peer %s', material['md5'], peer)
+        return True
+    try:
+        os.remove(save_path)
+    except FileNotFoundError:
+        pass
+    return False
@@ -9,8 +9,8 @@ from testbot.task import BotTask
 
 
 class AntiPlagiarismExecutor(GenericExecutor):
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
-        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id)
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, **kwargs):
+        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id, **kwargs)
 
         self.api = None
         self.file_requirement_id = None
@@ -18,7 +18,9 @@ class AntiPlagiarismExecutor(GenericExecutor):
 
     def prepare(self):
         super().prepare()
+        self._check_test_config()
 
+    def _check_test_config(self):
         config_type = self.test_config['type']
         if config_type != 'anti-plagiarism':
             raise ExecutorError('invalid config type for %s: %s' % (self.__class__.__name__, config_type))
@@ -40,12 +42,19 @@ class AntiPlagiarismExecutor(GenericExecutor):
     def run(self):
         super().run()
 
+        with self.tracer.span('anti_plagiarism.check'):
+            resp = requests.get('%s/api/check' % self.api, params=self._get_check_params())
+            resp.raise_for_status()
+        return self._process_check_result(resp.text)
+
+    def _get_check_params(self) -> dict:
         params = dict(rid=self.file_requirement_id, sid=self.submission_id)
         if self.template_file_id is not None:
             params['tid'] = self.template_file_id
-        resp = requests.get('%s/api/check' % self.api, params=params)
-        resp.raise_for_status()
-        result = resp.text.split('\n', 1)
+        return params
+
+    def _process_check_result(self, text: str):
+        result = text.split('\n', 1)
 
         if len(result) > 1:
             summary, report = result
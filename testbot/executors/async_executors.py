@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import traceback
+
+from testbot import async_api, async_runner
+from testbot.api import TransientAPIError
+from testbot.executors.anti_plagiarism import AntiPlagiarismExecutor
+from testbot.executors.file_exists import FileExistsExecutor
+from testbot.task import get_failure_report, get_retry_policy, get_success_report
+from testbot.tracing import get_tracing_config
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncExecutorMixin:
+    """
+    Run a light executor (i.e. without work folder) with asyncio, so that a single worker process can keep many of
+    them in flight. `dispatch` hands the executor to the shared event loop and returns at once without holding the
+    task thread, and the executor reports its result (or retries the task) when it finishes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the task request is thread-local, so keep it for the event loop
+        self.request = self.task.request
+
+    async def prepare_async(self):
+        with self.tracer.span('api.report_started'):
+            await async_api.report_started(self.submission_id, self.work_id, self.request.hostname, os.getpid())
+
+        # get submission info and test config
+        with self.tracer.span('api.get_submission_and_config'):
+            info = await async_api.get_submission_and_config(self.submission_id, self.work_id)
+        self._load_info(info)
+        self._check_test_config()
+
+    async def run_async(self):
+        return self.run()
+
+    async def clean_up_async(self):
+        if get_tracing_config().get('attach_summary'):
+            self.files_to_upload['trace-summary.json'] = json.dumps(self.tracer.summary(), indent=2)
+        if self.files_to_upload:
+            with self.tracer.span('api.upload_output_files'):
+                await async_api.upload_output_files(self.submission_id, self.work_id, self._get_files_to_upload())
+
+    async def start_async(self):
+        with self.tracer.span('task'):
+            try:
+                with self.tracer.span('prepare'):
+                    await self.prepare_async()
+                with self.tracer.span('run'):
+                    return self.compact_result(await self.run_async())
+            finally:
+                await self.clean_up_async()
+
+    async def _retry(self) -> bool:
+        """
+        Send the task again later, in the same way as `Task.retry`
+        :return: False if there are no retries left
+        """
+        max_retries, countdown = get_retry_policy(self.request.retries)
+        if self.request.retries >= max_retries:
+            return False
+        signature = self.task.signature_from_request(self.request, countdown=countdown,
+                                                     retries=self.request.retries + 1)
+        await asyncio.get_running_loop().run_in_executor(None, signature.apply_async)
+        return True
+
+    async def _start_and_report(self):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                report = get_success_report(await self.start_async())
+            except TransientAPIError as e:
+                if await self._retry():
+                    return
+                report = get_failure_report(e, traceback.format_exc())
+            except Exception as e:
+                report = get_failure_report(e, traceback.format_exc())
+            with self.tracer.span('api.report_result', final_state=report['final_state']):
+                await async_api.report_result(self.submission_id, self.work_id, report)
+        except Exception:
+            logger.exception('Failed to finish work %s of submission %d', self.work_id, self.submission_id)
+        finally:
+            # the exporters may block
+            await loop.run_in_executor(None, self.tracer.export)
+
+    def dispatch(self):
+        """
+        Hand the executor to the shared event loop. This only blocks while the loop is full (see `max_in_flight`).
+        """
+        async_runner.submit(self._start_and_report())
+
+
+class AsyncFileExistsExecutor(AsyncExecutorMixin, FileExistsExecutor):
+    pass
+
+
+class AsyncAntiPlagiarismExecutor(AsyncExecutorMixin, AntiPlagiarismExecutor):
+    async def run_async(self):
+        with self.tracer.span('anti_plagiarism.check'):
+            text = await async_api.request('GET', '%s/api/check' % self.api, auth=False,
+                                           params=self._get_check_params())
+        return self._process_check_result(text)
@@ -0,0 +1,155 @@
+import logging
+import os
+import shutil
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from testbot.api import get_submission_and_config, report_result
+from testbot.configs import config, data_folder
+from testbot.executors.env_test import EnvironmentTestExecutor
+from testbot.executors.errors import ExecutorError
+from testbot.task import BatchBotTask, get_failure_report, get_success_report
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEnvironmentTestRunner:
+    """
+    Run the tests of one test config for many submissions in a single task.
+
+    The environment is prepared (downloaded and unpacked) only once in a shared folder, and the submissions are then
+    tested through it with bounded parallelism. The result of each submission is reported individually.
+
+    The submissions are tested in threads of the task process, so the executors must not rely on process-wide state
+    (e.g. `preexec_fn` or per-pid temp files).
+
+    The reported submissions are recorded in a progress file, so that a task retried or delivered again (e.g. after a
+    lost worker) skips them and reuses the work folders of the others.
+    """
+
+    def __init__(self, task: BatchBotTask, executor_class, test_config_id: int, submission_ids: list,
+                 work_ids: list = None, parallelism: int = None):
+        """
+        :param task: the Celery task
+        :param executor_class: subclass of EnvironmentTestExecutor to test each submission
+        :param test_config_id: id of the test config
+        :param submission_ids: ids of the submissions
+        :param work_ids: ids of the work of each submission in the submission system, which is the task id by default
+        :param parallelism: max number of submissions tested at the same time
+        """
+        if work_ids is not None and len(work_ids) != len(submission_ids):
+            raise ExecutorError('Number of work ids does not match the number of submissions')
+        if parallelism is None:
+            batch_config = config.get('BATCH') or {}
+            parallelism = batch_config.get('parallelism', 2)
+
+        self.task = task
+        self.executor_class = executor_class
+        self.test_config_id = test_config_id
+        self.submission_ids = submission_ids
+        self.work_ids = work_ids or [task.request.id] * len(submission_ids)
+        self.parallelism = max(parallelism, 1)
+        self.env_source_folder = None
+        self.progress_path = os.path.join(data_folder, 'test_works', '%s-reported.txt' % task.request.id)
+        self._progress_lock = threading.Lock()
+
+    def _is_repeated(self) -> bool:
+        """
+        Whether the task is retried or delivered again, in which case its previous attempt may have left the env
+        folder, work folders and progress file
+        """
+        request = self.task.request
+        return bool(request.retries or (request.delivery_info or {}).get('redelivered'))
+
+    def _load_reported(self) -> set:
+        if not self._is_repeated() or not os.path.isfile(self.progress_path):
+            return set()
+        with open(self.progress_path) as f:
+            return {tuple(line.split()) for line in f if line.strip()}
+
+    def _record_reported(self, submission_id: int, work_id: str):
+        with self._progress_lock, open(self.progress_path, 'a') as f:
+            f.write('%d %s\n' % (submission_id, work_id))
+
+    def _prepare_env(self):
+        # use the test config of the first submission to find the environment
+        info = get_submission_and_config(self.submission_ids[0], self.work_ids[0])
+        test_config = info['config']
+        if test_config['id'] != self.test_config_id:
+            raise ExecutorError('Test config ID mismatch')
+        test_environment = test_config.get('environment')
+        if test_environment is None:
+            raise ExecutorError('Test environment not specified')
+
+        env_folder = os.path.join(data_folder, 'test_environments')
+        if not os.path.exists(env_folder):
+            raise ExecutorError('Test environment folder does not exist')
+        env_zip_path = EnvironmentTestExecutor._prepare_env_zip(env_folder, test_environment)
+
+        env_source_folder = os.path.join(data_folder, 'test_works', '%s-env' % self.task.request.id)
+        if os.path.lexists(env_source_folder):
+            if not self._is_repeated():
+                raise ExecutorError('Work folder already exists')
+            shutil.rmtree(env_source_folder)  # may be partially unpacked
+        shutil.unpack_archive(os.path.join(env_folder, env_zip_path), env_source_folder)
+        self.env_source_folder = env_source_folder
+
+    def _report_result(self, submission_id: int, work_id: str, report: dict) -> bool:
+        try:
+            report_result(submission_id, work_id, report)
+            self._record_reported(submission_id, work_id)
+            return True
+        except Exception:
+            # do not fail the other submissions of the batch
+            logger.exception('Failed to report the result of submission %d (work %s)', submission_id, work_id)
+            return False
+
+    def _run_one(self, request, submission_id: int, work_id: str) -> bool:
+        # the task request is thread-local, so make it available to the executor in this pool thread
+        self.task.push_request(**request.__dict__)
+        try:
+            executor = self.executor_class(task=self.task, submission_id=submission_id,
+                                           test_config_id=self.test_config_id, work_id=work_id,
+                                           work_name='%s-%d' % (request.id, submission_id),
+                                           env_source_folder=self.env_source_folder)
+            report = get_success_report(executor.start())
+        except Exception as e:
+            report = get_failure_report(e, traceback.format_exc())
+        finally:
+            self.task.pop_request()
+        reported = self._report_result(submission_id, work_id, report)
+        return reported and report['final_state'] == 'SUCCESS'
+
+    def start(self) -> dict:
+        reported = self._load_reported()
+        works = [(submission_id, work_id) for submission_id, work_id in zip(self.submission_ids, self.work_ids)
+                 if (str(submission_id), work_id) not in reported]
+        skipped = len(self.submission_ids) - len(works)
+        if not works:
+            return {'succeeded': 0, 'failed': 0, 'skipped': skipped}
+
+        # the progress file is only left behind if the worker is lost
+        try:
+            try:
+                self._prepare_env()
+            except Exception as e:
+                # report the failure to all the remaining submissions
+                report = get_failure_report(e, traceback.format_exc())
+                for submission_id, work_id in works:
+                    self._report_result(submission_id, work_id, report)
+                raise
+
+            try:
+                with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+                    request = self.task.request
+                    results = list(pool.map(lambda work: self._run_one(request, *work), works))
+            finally:
+                shutil.rmtree(self.env_source_folder, ignore_errors=True)
+        finally:
+            try:
+                os.remove(self.progress_path)
+            except FileNotFoundError:
+                pass
+        succeeded = sum(results)
+        return {'succeeded': succeeded, 'failed': len(results) - succeeded, 'skipped': skipped}
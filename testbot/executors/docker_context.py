@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+
+from docker.utils.build import PatternMatcher, exclude_paths
+
+SUBMISSION_FOLDER = 'submission'
+
+
+def read_dockerignore(root: str) -> list:
+    """
+    Read patterns from '.dockerignore' in the same way as docker-py does when building from a path
+    :param root: root folder of the build context
+    :return: list of patterns
+    """
+    path = os.path.join(root, '.dockerignore')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = [line.strip() for line in f.read().splitlines()]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _is_submission_path(path: str) -> bool:
+    return path == SUBMISSION_FOLDER or path.startswith(SUBMISSION_FOLDER + '/')
+
+
+def _add_path(tar: tarfile.TarFile, root: str, path: str):
+    full_path = os.path.join(root, path)
+    info = tar.gettarinfo(full_path, arcname=path)
+    if info is None:  # sockets and other unsupported files
+        return
+    if info.isfile():
+        with open(full_path, 'rb') as f:
+            tar.addfile(info, f)
+    else:
+        tar.addfile(info)
+
+
+class BuildContext:
+    """
+    Build context streamed to the Docker daemon from the cached environment segment followed by a tar of the
+    submission files, so the (possibly large) segment is not copied for each task. It can be used as the `fileobj`
+    of a custom context, which is sent with its length as the Content-Length.
+    """
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, segment, segment_size: int, tail):
+        """
+        :param segment: open file of the cached segment, which stays readable even if the cache file is replaced
+        :param segment_size: size of the segment to send, i.e. without the end-of-archive blocks
+        :param tail: file with the tar of the submission files (including the end-of-archive blocks)
+        """
+        self.segment = segment
+        self.segment_size = segment_size
+        self.tail = tail
+        self.tail_size = tail.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self.segment_size + self.tail_size
+
+    def __iter__(self):
+        self.segment.seek(0)
+        remaining = self.segment_size
+        while remaining > 0:
+            chunk = self.segment.read(min(remaining, self._CHUNK_SIZE))
+            if not chunk:
+                raise IOError('Cached build context segment is truncated')
+            remaining -= len(chunk)
+            yield chunk
+        self.tail.seek(0)
+        yield from iter(lambda: self.tail.read(self._CHUNK_SIZE), b'')
+
+    def close(self):
+        self.segment.close()
+        self.tail.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BuildContextCache:
+    """
+    Cache of the environment part of Docker build contexts.
+
+    For each environment (and its '.dockerignore' patterns), a manifest of the files to send and a tar segment with
+    those files (without the end-of-archive blocks) are saved next to the environment zip. The build context of a task
+    is then the cached segment followed by the submission files only. The segments of the previous versions of an
+    environment are removed when a new one is built.
+    """
+    _SPOOL_SIZE = 16 * 1024 * 1024  # max size of the submission files kept in memory
+
+    def __init__(self, env_folder: str):
+        self.env_folder = env_folder
+
+    def _get_cache_paths(self, env_id: int, env_md5: str, patterns: list):
+        patterns_md5 = hashlib.md5('\n'.join(patterns).encode()).hexdigest()[:8]
+        prefix = os.path.join(self.env_folder, '%d-%s-%s.context' % (env_id, env_md5, patterns_md5))
+        return prefix + '.json', prefix + '.tar'
+
+    def _remove_stale_segments(self, env_id: int, env_md5: str):
+        # builds still reading a removed segment keep it open
+        prefix = '%d-' % env_id
+        current_prefix = '%d-%s-' % (env_id, env_md5)
+        for name in os.listdir(self.env_folder):
+            if name.startswith(prefix) and not name.startswith(current_prefix) \
+                    and name.endswith(('.context.json', '.context.tar')):
+                try:
+                    os.remove(os.path.join(self.env_folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def _build_segment(self, root: str, patterns: list, manifest_path: str, segment_path: str) -> dict:
+        files = sorted(path for path in exclude_paths(root, list(patterns)) if not _is_submission_path(path))
+
+        # write to temp files and rename to avoid race condition with other workers
+        fd, tmp_segment_path = tempfile.mkstemp(suffix='.tar', dir=self.env_folder)
+        with os.fdopen(fd, 'wb') as f:
+            tar = tarfile.open(fileobj=f, mode='w')
+            for path in files:
+                _add_path(tar, root, path)
+            offset = tar.offset  # end of the last member, before the end-of-archive blocks
+            tar.close()
+        os.replace(tmp_segment_path, segment_path)
+
+        manifest = {'files': files, 'offset': offset}
+        fd, tmp_manifest_path = tempfile.mkstemp(suffix='.json', dir=self.env_folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest_path, manifest_path)
+        return manifest
+
+    def _load_manifest(self, manifest_path: str, segment_path: str):
+        if not os.path.isfile(manifest_path) or not os.path.isfile(segment_path):
+            return None
+        with open(manifest_path) as f:
+            try:
+                manifest = json.load(f)
+            except (TypeError, ValueError):
+                return None
+        if manifest.get('offset', -1) > os.path.getsize(segment_path):
+            return None
+        return manifest
+
+    def create_context(self, root: str, env_id: int, env_md5: str) -> BuildContext:
+        """
+        Create the build context of a work folder
+        :param root: work folder with the unpacked environment and the submission files
+        :param env_id: id of the environment
+        :param env_md5: md5 of the environment zip
+        :return: the build context, which should be closed after the build
+        """
+        patterns = read_dockerignore(root)
+        manifest_path, segment_path = self._get_cache_paths(env_id, env_md5, patterns)
+        manifest = self._load_manifest(manifest_path, segment_path)
+        if manifest is None:
+            manifest = self._build_segment(root, patterns, manifest_path, segment_path)
+            self._remove_stale_segments(env_id, env_md5)
+
+        try:
+            segment = open(segment_path, 'rb')
+        except FileNotFoundError:  # removed as stale after a newer version of the environment is built
+            manifest = self._build_segment(root, patterns, manifest_path, segment_path)
+            segment = open(segment_path, 'rb')
+        tail = tempfile.SpooledTemporaryFile(max_size=self._SPOOL_SIZE)
+        try:
+            # the submission files, appended to the cached environment part as tar members
+            matcher = PatternMatcher(patterns + ['!Dockerfile'])
+            tar = tarfile.open(fileobj=tail, mode='w')
+            submission_root = os.path.join(root, SUBMISSION_FOLDER)
+            if os.path.isdir(submission_root) and not matcher.matches(SUBMISSION_FOLDER):
+                _add_path(tar, root, SUBMISSION_FOLDER)
+                for dir_path, dir_names, file_names in os.walk(submission_root):
+                    dir_names.sort()
+                    rel_dir = os.path.relpath(dir_path, root)
+                    for name in dir_names + sorted(file_names):
+                        path = os.path.join(rel_dir, name)
+                        if not matcher.matches(path):
+                            _add_path(tar, root, path)
+            tar.close()
+            return BuildContext(segment, manifest['offset'], tail)
+        except Exception:
+            segment.close()
+            tail.close()
+            raise
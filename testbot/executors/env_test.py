@@ -2,20 +2,34 @@ import json
 import os
 import random
 import shutil
+import tarfile
+import zipfile
 
 from testbot.api import download_material, download_submission_file
-from testbot.configs import data_folder
+from testbot.configs import config, data_folder
+from testbot.env_cache_peers import fetch_from_peers
+from testbot.file_cache import get_submission_file_cache
 from testbot.executors.errors import ExecutorError
 from testbot.executors.generic import GenericExecutor
+from testbot.executors.output_scanner import TagScanner
 from testbot.task import BotTask
 
 
 class EnvironmentTestExecutor(GenericExecutor):
     EXIT_STATUS_TIMEOUT = 124
     EXIT_STATUS_KILLED = 137
+    _MAX_ERROR_LINES = 1000
+    _SHARE_ENV_FILES = False  # whether the environment files can be hard-linked from a shared folder
+    _SHARE_SUBMISSION_FILES = False  # whether the submission files can be hard-linked (read-only) from the cache
 
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
-        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id)
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, env_source_folder: str = None,
+                 **kwargs):
+        """
+        :param env_source_folder: folder with the unpacked environment to copy from, instead of unpacking the
+        environment zip again
+        """
+        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id, **kwargs)
+        self.env_source_folder = env_source_folder
         self.environment = None
         self.result_tag = None
         self.error_tag = None
@@ -34,17 +48,33 @@ class EnvironmentTestExecutor(GenericExecutor):
         if not os.path.exists(env_folder):
             raise ExecutorError('Test environment folder does not exist')
 
-        env_zip_path = self._prepare_env_zip(env_folder, test_environment)
-        # unpack environment zip to work folder
-        shutil.unpack_archive(os.path.join(env_folder, env_zip_path), self.work_folder)
+        with self.tracer.span('env_cache_lookup', environment_id=test_environment['id']):
+            env_zip_path = os.path.join(env_folder, self._prepare_env_zip(env_folder, test_environment))
+        # place small environments in tmpfs if possible
+        file_cache = get_submission_file_cache()
+        self._use_tmpfs_work_folder(lambda: self._get_required_size(env_zip_path, file_cache))
+        with self.tracer.span('unzip', tmpfs=self.work_folder_in_tmpfs):
+            if self.env_source_folder:
+                # copy the prepared environment to work folder
+                self._copy_env_files(self.env_source_folder, self.work_folder)
+            else:
+                # unpack environment zip to work folder
+                shutil.unpack_archive(env_zip_path, self.work_folder)
 
         # download submission files into sub folder 'submission'
         submission_folder = os.path.join(self.work_folder, 'submission')
         if not os.path.lexists(submission_folder):
             os.mkdir(submission_folder)
-        for file in self.submission['files']:
-            local_save_path = os.path.join(self.work_folder, 'submission', file['requirement']['name'])
-            download_submission_file(self.submission_id, self.task.request.id, file, local_save_path)
+        with self.tracer.span('api.download_submission_files', files=len(self.submission['files'])):
+            for file in self.submission['files']:
+                local_save_path = os.path.join(self.work_folder, 'submission', file['requirement']['name'])
+                if os.path.lexists(local_save_path):
+                    os.remove(local_save_path)  # do not write through a hard link to the shared environment files
+                if file_cache is not None:
+                    file_cache.download(self.submission_id, self.work_id, file, local_save_path,
+                                        hard_link=self._SHARE_SUBMISSION_FILES)
+                else:
+                    download_submission_file(self.submission_id, self.work_id, file, local_save_path)
 
         # generate randomized result tag
         rand_int = random.randint(10000000, 99999999)
@@ -62,6 +92,15 @@ class EnvironmentTestExecutor(GenericExecutor):
         if team_id is not None:
             self.env_vars['SUBMITTER_TEAM_ID'] = str(team_id)
 
+    def _copy_env_files(self, src: str, dst: str):
+        def _link_or_copy(src_file, dst_file):
+            try:
+                os.link(src_file, dst_file)
+            except OSError:  # e.g. cross-device link
+                shutil.copy2(src_file, dst_file)
+
+        shutil.copytree(src, dst, symlinks=True, copy_function=_link_or_copy if self._SHARE_ENV_FILES else shutil.copy2)
+
     @staticmethod
     def _prepare_env_zip(env_folder: str, test_environment: dict) -> str:
         env_id = test_environment['id']
@@ -81,9 +120,9 @@ class EnvironmentTestExecutor(GenericExecutor):
             if env_zip_path and not os.path.isfile(os.path.join(env_folder, env_zip_path)):
                 env_zip_path = None
 
-        # download environment if no cache found
+        # download environment if no cache found, from the peers first and then the server
         if not env_zip_path:
-            env_zip_path = download_material(test_environment, env_folder)
+            env_zip_path = download_material(test_environment, env_folder, fetch=fetch_from_peers)
             try:
                 # use exclusive file lock to avoid race condition
                 lock_path = os.path.join(env_folder, "%d.lock" % env_id)
@@ -99,49 +138,69 @@ class EnvironmentTestExecutor(GenericExecutor):
                 pass
         return env_zip_path
 
+    def _get_required_size(self, env_zip_path: str, file_cache):
+        """
+        Estimate the size of the work folder, i.e. the unpacked environment and the submission files
+        :return: size in bytes, or None if the archive format is not recognized
+        """
+        env_size = self._get_unpacked_size(env_zip_path)
+        if env_size is None:
+            return None
+        # the size of a submission file is known if it is given by the server or cached
+        unknown_file_size = (config.get('WORK_TMPFS') or {}).get('unknown_file_size', 1) * 1024 * 1024
+        files_size = 0
+        for file in self.submission['files']:
+            size = file.get('size')
+            if size is None and file_cache is not None:
+                size = file_cache.get_size(file['md5'])
+            files_size += unknown_file_size if size is None else size
+        return env_size + files_size
+
+    @staticmethod
+    def _get_unpacked_size(archive_path: str):
+        """
+        Get the total uncompressed size of the files in a zip or tar archive without unpacking it
+        :param archive_path: path of the archive
+        :return: size in bytes, or None if the archive format is not recognized
+        """
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as f_zip:
+                return sum(info.file_size for info in f_zip.infolist())
+        if tarfile.is_tarfile(archive_path):
+            with tarfile.open(archive_path) as f_tar:
+                return sum(member.size for member in f_tar.getmembers())
+        return None
+
+    def scan_output(self, raw_output, result: bool = True, errors: bool = True) -> TagScanner:
+        """
+        Scan the raw output for the result and error lines in a single pass
+        :param raw_output: raw output from the test script or command inside Docker
+        :param result: whether to look for the result line
+        :param errors: whether to collect the error lines
+        :return: finished scanner
+        """
+        scanner = TagScanner(self.result_tag if result else None, self.error_tag if errors else None,
+                             max_errors=self._MAX_ERROR_LINES)
+        scanner.feed(raw_output)
+        scanner.finish()
+        return scanner
+
     def extract_result(self, raw_output):
         """
         Try to parse the last line that starts with the `result_tag` from the raw output as the result
         :param raw_output: raw output from the test script or command inside Docker
-        :param result_tag: tag for the result line
         :return: result if parsed successfully
         """
         if not raw_output or not self.result_tag:
             return None
-        if isinstance(raw_output, (bytes, bytearray)):
-            raw_output = raw_output.decode()
-        lines = raw_output.strip().split('\n')
-
-        result = None
-        for line in lines:
-            line = line.strip()
-            if line and line.startswith(self.result_tag):
-                result = line[len(self.result_tag):].strip()
-
-        if result is None:
-            return None
-        try:
-            return json.loads(result)
-        except (ValueError, TypeError):
-            return result
+        return self.scan_output(raw_output, errors=False).result
 
     def extract_errors(self, raw_output):
         """
-        Try to extract all the lines that starts with the `error_tag` from the raw output as the errors
+        Try to extract the lines that starts with the `error_tag` from the raw output as the errors
         :param raw_output: raw output from the test script or command inside Docker
-        :param error_tag: tag for the error line
         :return: result if extracted successfully
         """
         if not raw_output or not self.error_tag:
             return None
-        if isinstance(raw_output, (bytes, bytearray)):
-            raw_output = raw_output.decode()
-        lines = raw_output.strip().split('\n')
-
-        errors = []
-        for line in lines:
-            line = line.strip()
-            if line and line.startswith(self.error_tag):
-                errors.append(line[len(self.error_tag):].strip())
-
-        return errors
+        return self.scan_output(raw_output, result=False).errors
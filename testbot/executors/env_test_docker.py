@@ -1,23 +1,68 @@
 import json
+import logging
 import os
+import re
+import tempfile
 
 import docker
 from docker.errors import ContainerError, BuildError
 
+from testbot.configs import data_folder
+from testbot.docker_gc import get_labels
+from testbot.executors.docker_context import BuildContextCache
 from testbot.executors.env_test import EnvironmentTestExecutor
 from testbot.executors.errors import ExecutorError
 from testbot.task import BotTask
 
+logger = logging.getLogger(__name__)
+
+
+class BuildLogSpool:
+    """
+    Spool file for Docker build logs, where each log entry is written as a compact JSON line as soon as it is produced.
+    Entries after the size limit are dropped and a truncation marker is appended at the end.
+    """
+
+    def __init__(self, size_limit: int):
+        self.size_limit = size_limit
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, entry: dict):
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        if self.dropped or self.size + len(line) > self.size_limit:
+            self.dropped += 1
+            return
+        self.file.write(line)
+        self.size += len(line)
+
+    def read(self) -> bytes:
+        if self.dropped:
+            self.file.write((json.dumps({'truncated': True, 'dropped_entries': self.dropped}) + '\n').encode())
+            self.dropped = 0
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
 
 class DockerEnvironmentTestExecutor(EnvironmentTestExecutor):
     _DOCKER_CLIENT = None
     _LOG_LENGTH_LIMIT = 10 * 1024 * 1024  # 10MB
+    _BUILD_LOG_LENGTH_LIMIT = 10 * 1024 * 1024  # 10MB
+    _BUILD_STEP_PATTERN = re.compile(r'^Step \d+/\d+ : ')
+
+    _SHARE_ENV_FILES = True  # the environment files are only read when building the image
+    _SHARE_SUBMISSION_FILES = True  # so are the submission files, which are copied into the image or mounted read-only
 
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, **kwargs):
         super(DockerEnvironmentTestExecutor, self).__init__(task=task, submission_id=submission_id,
-                                                            test_config_id=test_config_id)
+                                                            test_config_id=test_config_id, **kwargs)
         self.docker_client = None
         self.run_params = {}
+        self.submission_mount_target = None
 
     def prepare(self):
         super(DockerEnvironmentTestExecutor, self).prepare()
@@ -26,19 +71,45 @@ class DockerEnvironmentTestExecutor(EnvironmentTestExecutor):
         if config_type != 'docker':
             raise ExecutorError('invalid config type for %s: %s' % (self.__class__.__name__, config_type))
 
-        # Get Docker client
-        if self._DOCKER_CLIENT is None:
-            self._DOCKER_CLIENT = docker.from_env()  # lazy-load a global Docker client
-        self.docker_client = self._DOCKER_CLIENT  # reuse the client
+        self.docker_client = self.get_docker_client()
 
         # 'Dockerfile' is required
         dockerfile = os.path.join(self.work_folder, 'Dockerfile')
         if not os.path.isfile(dockerfile):
             raise ExecutorError('Dockerfile not found')
 
+        # mount submission files instead of copying them into the image if the test config opts in
+        submission_target = self.test_config.get('docker_submission_target')
+        if submission_target:
+            self._prepare_submission_mount(submission_target)
+
         # get config for running the Docker container
         self._prepare_run_params()
 
+    @classmethod
+    def get_docker_client(cls):
+        """
+        Get the global Docker client of the current process, which is created and health-checked on the first call
+        """
+        if DockerEnvironmentTestExecutor._DOCKER_CLIENT is None:
+            client = docker.from_env()
+            client.ping()
+            DockerEnvironmentTestExecutor._DOCKER_CLIENT = client
+        return DockerEnvironmentTestExecutor._DOCKER_CLIENT
+
+    def _prepare_submission_mount(self, target: str):
+        # keep the submission out of the build context so 'COPY ./submission' only copies an empty folder and the
+        # image layers stay the same for all the submissions
+        dockerignore = os.path.join(self.work_folder, '.dockerignore')
+        content = ''
+        if os.path.isfile(dockerignore):
+            with open(dockerignore) as f:
+                content = f.read()
+            os.remove(dockerignore)  # do not write through a hard link to the shared environment files
+        with open(dockerignore, 'w') as f:
+            f.write(content + '\nsubmission/*\n')
+        self.submission_mount_target = target
+
     def _prepare_run_params(self):
         run_params = {
             'remove': True,  # by default, remove container after exit
@@ -58,27 +129,60 @@ class DockerEnvironmentTestExecutor(EnvironmentTestExecutor):
                 run_params['mem_limit'] = '%dm' % v
             elif k == 'docker_network':
                 run_params['network_disabled'] = not v
+        if self.submission_mount_target:
+            submission_folder = os.path.abspath(os.path.join(self.work_folder, 'submission'))
+            run_params['volumes'] = {submission_folder: {'bind': self.submission_mount_target, 'mode': 'ro'}}
         self.run_params = run_params
 
+    def _build_image(self, context, tag: str, labels: dict, build_log_spool: BuildLogSpool):
+        """
+        Build the image with the low-level API to stream the build logs into the spool instead of keeping them in memory
+        """
+        image_id = None
+        for entry in self.docker_client.api.build(fileobj=context, custom_context=True, tag=tag, labels=labels, rm=True,
+                                                  decode=True):
+            build_log_spool.write(entry)
+            if 'error' in entry:
+                raise BuildError(entry['error'], [])
+            stream = entry.get('stream')
+            if stream:
+                if self._BUILD_STEP_PATTERN.match(stream):
+                    logger.info('[%s] %s', tag, stream.strip())  # progress of long builds
+                match = re.search(r'(^Successfully built |sha256:)([0-9a-f]+)$', stream.strip())
+                if match:
+                    image_id = match.group(2)
+            aux = entry.get('aux')
+            if aux and 'ID' in aux:
+                image_id = aux['ID']
+        if image_id is None:
+            raise BuildError('Unknown build result', [])
+        return self.docker_client.images.get(image_id)
+
     def run(self):
         super(DockerEnvironmentTestExecutor, self).run()
 
         # build Docker image
-        build_logs = None
+        context_cache = BuildContextCache(os.path.join(data_folder, 'test_environments'))
+        with self.tracer.span('docker.build_context'):
+            context = context_cache.create_context(self.work_folder, self.environment['id'], self.environment['md5'])
+        tag = 'submit-test-%s' % self.work_name
+        labels = get_labels(self.work_name, self.environment['id'])
+        build_log_spool = BuildLogSpool(self._BUILD_LOG_LENGTH_LIMIT)
         try:
-            tag = 'submit-test-%s' % self.task.request.id
-            image, build_logs = self.docker_client.images.build(path=self.work_folder, tag=tag)
-        except BuildError as e:
-            build_logs = e.build_log
-            raise
+            with context, self.tracer.span('docker.build'):
+                image = self._build_image(context, tag, labels, build_log_spool)
         finally:
+            build_logs = build_log_spool.read()
+            build_log_spool.close()
             if build_logs:
-                self.files_to_upload['docker-build-logs.json'] = json.dumps(list(build_logs), indent=2)
+                self.files_to_upload['docker-build-logs.jsonl'] = build_logs
 
         # run a Docker container with the specified limits and the new image
         try:
             # logs from stdout and stderr are combined due to the design of the API
-            logs = self.docker_client.containers.run(image.id, name=tag, stdout=True, stderr=True, **self.run_params)
+            with self.tracer.span('docker.run'):
+                logs = self.docker_client.containers.run(image.id, name=tag, stdout=True, stderr=True, labels=labels,
+                                                         **self.run_params)
             if logs:
                 if len(logs) > self._LOG_LENGTH_LIMIT:
                     self.files_to_upload['docker-run-logs.truncated.txt'] = logs[:self._LOG_LENGTH_LIMIT]
@@ -103,7 +207,8 @@ class DockerEnvironmentTestExecutor(EnvironmentTestExecutor):
             try:
                 self.docker_client.images.remove(image.id)
             except docker.errors.APIError as e:
-                # keep the error message but do not treat it as a failure
+                # keep the error message but do not treat it as a failure, the image will be removed by the garbage
+                # collector later
                 self.files_to_upload['docker-remove-image-error.txt'] = str(e)
 
         return result
@@ -1,17 +1,21 @@
+import json
 import os
-import subprocess
+import signal
 
+from testbot.configs import config
 from testbot.executors.env_test import EnvironmentTestExecutor
 from testbot.executors.errors import ExecutorError
+from testbot.executors.resource_limits import ResourceLimits, run_with_limits
 from testbot.task import BotTask
 
 
 class ScriptEnvironmentTestExecutor(EnvironmentTestExecutor):
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, **kwargs):
         super(ScriptEnvironmentTestExecutor, self).__init__(task=task, submission_id=submission_id,
-                                                            test_config_id=test_config_id)
+                                                            test_config_id=test_config_id, **kwargs)
         self.run_script = None
         self.combined_env_vars = {}
+        self.limits = None
 
     def prepare(self):
         super(ScriptEnvironmentTestExecutor, self).prepare()
@@ -21,7 +25,7 @@ class ScriptEnvironmentTestExecutor(EnvironmentTestExecutor):
             raise ExecutorError('invalid config type for %s: %s' % (self.__class__.__name__, config_type))
 
         # Look for 'run.sh' and we will run it in the current environment directly, which has no system isolation or
-        # time/resource/network restrictions.
+        # time/network restrictions. CPU, memory and PID limits are applied by cgroup or prlimit.
         run_script = os.path.join(self.work_folder, 'run.sh')
         if not os.path.isfile(run_script):
             raise ExecutorError('Test script "run.sh" not found')
@@ -32,24 +36,36 @@ class ScriptEnvironmentTestExecutor(EnvironmentTestExecutor):
         env.update(self.env_vars)
         self.combined_env_vars = env
 
+        # resource limits share the config keys with Docker tests, with defaults in the worker config
+        run_script_config = config.get('RUN_SCRIPT') or {}
+        cpus = self.test_config.get('docker_cpus')
+        memory = self.test_config.get('docker_memory')
+        self.limits = ResourceLimits(cpus=cpus if cpus is not None else run_script_config.get('cpus'),
+                                     memory=memory if memory is not None else run_script_config.get('memory'),
+                                     pids=run_script_config.get('pids_max'))
+
     def run(self):
         super(ScriptEnvironmentTestExecutor, self).run()
 
-        proc_result = subprocess.run(['bash', os.path.abspath(self.run_script)], cwd=self.work_folder,
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.combined_env_vars)
-        if proc_result.stdout:
-            self.files_to_upload['stdout.txt'] = proc_result.stdout
-        if proc_result.stderr:
-            self.files_to_upload['stderr.txt'] = proc_result.stderr
+        run_script_config = config.get('RUN_SCRIPT') or {}
+        with self.tracer.span('script.run'):
+            return_code, stdout, stderr, usage = run_with_limits(
+                ['bash', os.path.abspath(self.run_script)], cwd=self.work_folder, env=self.combined_env_vars,
+                limits=self.limits, cgroup_root=run_script_config.get('cgroup_root'),
+                cgroup_name='submit-test-%s' % self.work_name)
+        if stdout:
+            self.files_to_upload['stdout.txt'] = stdout
+        if stderr:
+            self.files_to_upload['stderr.txt'] = stderr
+        self.files_to_upload['resource-usage.json'] = json.dumps(usage)
 
-        return_code = proc_result.returncode
         if return_code:
             if return_code == self.EXIT_STATUS_TIMEOUT:
                 raise TimeoutError('Test timeout')
-            if return_code == self.EXIT_STATUS_KILLED:
+            if return_code in (self.EXIT_STATUS_KILLED, -signal.SIGKILL):
                 raise OSError('Test killed')
-            errors = self.extract_errors(proc_result.stderr)
+            errors = self.extract_errors(stderr)
             if errors:
                 raise RuntimeError(' \n'.join(errors))
             raise RuntimeError('Test returned exit code %d' % return_code)
-        return self.extract_result(proc_result.stdout)
+        return self.extract_result(stdout)
@@ -4,14 +4,16 @@ from testbot.task import BotTask
 
 
 class FileExistsExecutor(GenericExecutor):
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
-        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id)
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, **kwargs):
+        super().__init__(task=task, submission_id=submission_id, test_config_id=test_config_id, **kwargs)
 
         self.file_requirement_id = None
 
     def prepare(self):
         super().prepare()
+        self._check_test_config()
 
+    def _check_test_config(self):
         config_type = self.test_config['type']
         if config_type != 'file-exists':
             raise ExecutorError('invalid config type for %s: %s' % (self.__class__.__name__, config_type))
@@ -1,28 +1,55 @@
+import gzip
+import json
 import os
+import shutil
 
 from testbot.api import report_started, get_submission_and_config, upload_output_files
-from testbot.configs import data_folder
+from testbot.configs import config, data_folder
 from testbot.executors.errors import ExecutorError
 from testbot.task import BotTask
+from testbot.tracing import create_tracer, get_tracing_config
 
 
 class GenericExecutor:
-    def __init__(self, task: BotTask, submission_id: int, test_config_id: int):
+    _RESULT_ARTIFACT = 'result.json.gz'
+    _COMPRESSIBLE_EXTENSIONS = ('.txt', '.json', '.jsonl', '.log')
+
+    def __init__(self, task: BotTask, submission_id: int, test_config_id: int, work_id: str = None,
+                 work_name: str = None):
+        """
+        :param task: the Celery task
+        :param submission_id: id of the submission
+        :param test_config_id: id of the test config
+        :param work_id: id of the work in the submission system, which is the task id by default
+        :param work_name: unique name of the work folder and other local resources, which is the work id by default
+        """
         self.task = task
         self.submission_id = submission_id
         self.test_config_id = test_config_id
+        self.work_id = work_id or task.request.id
+        self.work_name = work_name or self.work_id
 
         self.submission = None
         self.test_config = None
         self.work_folder = None
+        self.work_folder_in_tmpfs = False
         self.files_to_upload = {}
+        self.tracer = create_tracer(task.request.id, submission_id=submission_id, test_config_id=test_config_id,
+                                    executor=self.__class__.__name__)
 
     def prepare(self):
-        report_started(self.submission_id, self.task.request.id, self.task.request.hostname, os.getpid())
+        with self.tracer.span('api.report_started'):
+            report_started(self.submission_id, self.work_id, self.task.request.hostname, os.getpid())
 
         # get submission info and test config
-        info = get_submission_and_config(self.submission_id, self.task.request.id)
+        with self.tracer.span('api.get_submission_and_config'):
+            info = get_submission_and_config(self.submission_id, self.work_id)
+        self._load_info(info)
 
+    def _load_info(self, info: dict):
+        """
+        Check and load the submission info and test config, and find the work folder
+        """
         submission = info['submission']
         if submission['id'] != self.submission_id:
             raise ExecutorError('Submission ID mismatch')
@@ -43,21 +70,110 @@ class GenericExecutor:
         if not os.path.exists(works_folder):
             raise ExecutorError('Folder for all work does not exist')
         # check work folder for the current task
-        work_folder = os.path.join(works_folder, self.task.request.id)
+        work_folder = os.path.join(works_folder, self.work_name)
+        # keep the prepared files (e.g. partial downloads) when the task is retried or delivered again
+        redelivered = (self.task.request.delivery_info or {}).get('redelivered')
+        if os.path.lexists(work_folder) and not self.task.request.retries and not redelivered:
+            raise ExecutorError('Work folder already exists')
+        self.work_folder = work_folder
+
+    def _use_tmpfs_work_folder(self, get_required_size) -> bool:
+        """
+        Try to move the work folder (not created yet) to the RAM-backed file system specified by `WORK_TMPFS` in the
+        config. The work folder stays on the data disk if tmpfs is not configured, the required size is above the
+        threshold or there is not enough free space left in tmpfs.
+        :param get_required_size: function to estimate the size (in bytes) of the content of the work folder, which
+        is only called if tmpfs is configured and may return None if the size is unknown
+        :return: True if the work folder is placed on tmpfs
+        """
+        tmpfs_config = config.get('WORK_TMPFS')
+        if not tmpfs_config:
+            return False
+        tmpfs_folder = tmpfs_config.get('path')
+        max_size = tmpfs_config.get('max_size')  # MB
+        if not tmpfs_folder or max_size is None:
+            return False
+        required_size = get_required_size()
+        if required_size is None or required_size > max_size * 1024 * 1024:
+            return False
+
+        os.makedirs(tmpfs_folder, exist_ok=True)
+        min_free = tmpfs_config.get('min_free', 0)  # MB
+        if shutil.disk_usage(tmpfs_folder).free - required_size < min_free * 1024 * 1024:
+            return False
+
+        work_folder = os.path.join(tmpfs_folder, self.work_name)
         if os.path.lexists(work_folder):
             raise ExecutorError('Work folder already exists')
         self.work_folder = work_folder
+        self.work_folder_in_tmpfs = True
+        return True
 
     def run(self):
         pass
 
+    def compact_result(self, result):
+        """
+        Move the result into a compressed artifact if its JSON size exceeds `RESULT.max_size` in the config
+        :param result: result of the test
+        :return: the result itself, or a reference to the artifact
+        """
+        result_config = config.get('RESULT') or {}
+        max_size = result_config.get('max_size')
+        if max_size is None or result is None:
+            return result
+        data = json.dumps(result).encode()
+        if len(data) <= max_size:
+            return result
+        self.files_to_upload[self._RESULT_ARTIFACT] = gzip.compress(data)
+        return {
+            'truncated': True,
+            'artifact': self._RESULT_ARTIFACT,
+            'size': len(data)
+        }
+
+    def _get_files_to_upload(self) -> dict:
+        """
+        Get the output files to upload, where text files larger than `RESULT.compress_min_size` are gzipped if
+        `RESULT.compress_artifacts` is enabled in the config
+        """
+        result_config = config.get('RESULT') or {}
+        if not result_config.get('compress_artifacts'):
+            return self.files_to_upload
+        min_size = result_config.get('compress_min_size', 4096)
+
+        files = {}
+        for name, content in self.files_to_upload.items():
+            if isinstance(content, str):
+                content = content.encode()
+            if isinstance(content, (bytes, bytearray)) and len(content) >= min_size \
+                    and name.endswith(self._COMPRESSIBLE_EXTENSIONS):
+                files[name + '.gz'] = gzip.compress(content)
+            else:
+                files[name] = content
+        return files
+
     def clean_up(self):
-        if self.files_to_upload:
-            upload_output_files(self.submission_id, self.task.request.id, self.files_to_upload)
+        try:
+            if get_tracing_config().get('attach_summary'):
+                self.files_to_upload['trace-summary.json'] = json.dumps(self.tracer.summary(), indent=2)
+            if self.files_to_upload:
+                with self.tracer.span('api.upload_output_files'):
+                    upload_output_files(self.submission_id, self.work_id, self._get_files_to_upload())
+        finally:
+            # work folders on disk are kept for inspection, but those in tmpfs would use up the memory
+            if self.work_folder_in_tmpfs and self.work_folder:
+                shutil.rmtree(self.work_folder, ignore_errors=True)
 
     def start(self):
         try:
-            self.prepare()
-            return self.run()
+            with self.tracer.span('task'):
+                try:
+                    with self.tracer.span('prepare'):
+                        self.prepare()
+                    with self.tracer.span('run'):
+                        return self.compact_result(self.run())
+                finally:
+                    self.clean_up()
         finally:
-            self.clean_up()
+            self.tracer.export()
@@ -0,0 +1,86 @@
+import json
+
+
+class TagScanner:
+    """
+    Single-pass scanner for the result and error lines in the output of a test.
+
+    The output is fed as bytes, in one piece or in chunks while it streams in. A line is a result (or error) line if it
+    starts with the result (or error) tag after stripping the leading whitespaces. The last result line and the first
+    `max_errors` error lines are kept.
+    """
+
+    def __init__(self, result_tag: str = None, error_tag: str = None, max_errors: int = 1000):
+        self.result_tag = result_tag.encode() if result_tag else None
+        self.error_tag = error_tag.encode() if error_tag else None
+        self.max_errors = max_errors
+
+        self.result_line = None
+        self.error_lines = []
+        self.num_errors = 0
+        self.finished = False
+        self._pending = b''
+
+    def feed(self, chunk):
+        if self.finished:
+            raise ValueError('Scanner already finished')
+        if not chunk:
+            return
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = self._pending + chunk if self._pending else bytes(chunk)
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._pending = data
+            return
+        self._pending = data[end + 1:]
+        self._scan(data, end)
+
+    def finish(self):
+        if self.finished:
+            return
+        if self._pending:
+            self._scan(self._pending, len(self._pending))
+            self._pending = b''
+        self.finished = True
+
+    def _find_lines(self, data: bytes, end: int, tag: bytes):
+        """
+        Find the content of the lines that start with the tag in data[:end]
+        """
+        pos = data.find(tag, 0, end)
+        while pos >= 0:
+            line_start = data.rfind(b'\n', 0, pos) + 1
+            line_end = data.find(b'\n', pos, end)
+            if line_end < 0:
+                line_end = end
+            if line_start == pos or not data[line_start:pos].strip():
+                yield data[pos + len(tag):line_end]
+            pos = data.find(tag, line_end, end)
+
+    def _scan(self, data: bytes, end: int):
+        if self.result_tag:
+            for line in self._find_lines(data, end, self.result_tag):
+                self.result_line = line
+        if self.error_tag:
+            for line in self._find_lines(data, end, self.error_tag):
+                self.num_errors += 1
+                if len(self.error_lines) < self.max_errors:
+                    self.error_lines.append(line)
+
+    @property
+    def result(self):
+        """
+        The content of the last result line, parsed as JSON if possible
+        """
+        if self.result_line is None:
+            return None
+        result = self.result_line.decode(errors='replace').strip()
+        try:
+            return json.loads(result)
+        except (ValueError, TypeError):
+            return result
+
+    @property
+    def errors(self) -> list:
+        return [line.decode(errors='replace').strip() for line in self.error_lines]
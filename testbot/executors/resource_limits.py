@@ -0,0 +1,212 @@
+import logging
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceLimits:
+    def __init__(self, cpus: float = None, memory: int = None, pids: int = None):
+        """
+        :param cpus: number of CPUs (quota), e.g. 1.5
+        :param memory: max memory in MB
+        :param pids: max number of processes
+        """
+        self.cpus = cpus
+        self.memory = memory
+        self.pids = pids
+
+
+class _Cgroup:
+    """
+    A cgroup (v2) for one process tree, created under a delegated root folder
+    """
+    _CPU_PERIOD = 100000
+
+    def __init__(self, root: str, name: str):
+        self.path = os.path.join(root, name)
+
+    def create(self, limits: ResourceLimits):
+        """
+        Create the cgroup with the limits, where the folder is removed again if any limit cannot be applied (e.g. the
+        controller is not enabled in `cgroup.subtree_control` of the root)
+        """
+        os.mkdir(self.path)
+        try:
+            if limits.cpus is not None:
+                self._write('cpu.max', '%d %d' % (int(limits.cpus * self._CPU_PERIOD), self._CPU_PERIOD))
+            if limits.memory is not None:
+                self._write('memory.max', str(limits.memory * 1024 * 1024))
+                self._write('memory.swap.max', '0', ignore_missing=True)  # missing without swap accounting
+            if limits.pids is not None:
+                self._write('pids.max', str(limits.pids))
+        except OSError:
+            os.rmdir(self.path)
+            raise
+
+    def _write(self, name: str, value: str, ignore_missing: bool = False):
+        path = os.path.join(self.path, name)
+        # a missing interface file cannot be created in cgroupfs, which fails with EACCES instead of ENOENT
+        if ignore_missing and not os.path.exists(path):
+            return
+        with open(path, 'w') as f:
+            f.write(value)
+
+    def _read(self, name: str):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def add(self, pid: int):
+        """
+        Move a process into this cgroup. The writer needs write access to `cgroup.procs` of the common ancestor of the
+        source and this cgroup, i.e. the worker itself must run inside the delegated hierarchy.
+        """
+        with open(os.path.join(self.path, 'cgroup.procs'), 'w') as f:
+            f.write(str(pid))
+
+    def get_usage(self) -> dict:
+        usage = {'cpu_seconds': None, 'peak_memory_bytes': None, 'io_read_bytes': None, 'io_write_bytes': None}
+        cpu_stat = self._read('cpu.stat')
+        if cpu_stat:
+            for line in cpu_stat.splitlines():
+                key, value = line.split()
+                if key == 'usage_usec':
+                    usage['cpu_seconds'] = int(value) / 1e6
+        memory_peak = self._read('memory.peak')  # Linux 5.19+
+        if memory_peak:
+            usage['peak_memory_bytes'] = int(memory_peak)
+        io_stat = self._read('io.stat')
+        if io_stat is not None:
+            usage['io_read_bytes'] = usage['io_write_bytes'] = 0
+            for line in io_stat.splitlines():
+                for field in line.split()[1:]:
+                    key, value = field.split('=', 1)
+                    if key == 'rbytes':
+                        usage['io_read_bytes'] += int(value)
+                    elif key == 'wbytes':
+                        usage['io_write_bytes'] += int(value)
+        return usage
+
+    def destroy(self):
+        if os.path.exists(os.path.join(self.path, 'cgroup.kill')):  # Linux 5.14+
+            self._write('cgroup.kill', '1')
+        else:
+            for pid in (self._read('cgroup.procs') or '').split():
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        for _ in range(50):  # wait for the killed processes to leave
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError:
+                time.sleep(0.1)
+
+
+def _read_pipe(pipe, chunks: list):
+    with pipe:
+        for chunk in iter(lambda: pipe.read(65536), b''):
+            chunks.append(chunk)
+
+
+def _set_rlimit(pid: int, limit: int, value: int):
+    # a soft and hard limit above the current hard limit is not allowed for an unprivileged user
+    hard = resource.getrlimit(limit)[1]
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.prlimit(pid, limit, (value, value))
+
+
+def run_with_limits(args: list, cwd: str, env: dict, limits: ResourceLimits, cgroup_root: str = None,
+                    cgroup_name: str = None):
+    """
+    Run a command in its own process group with resource limits, and measure its resource usage.
+
+    The command is started behind a shell that waits on its stdin, so that the limits are applied to the process from
+    the parent before the command is executed. If `cgroup_root` is a writable folder of a delegated cgroup v2
+    hierarchy which the worker itself runs in, the process tree is placed in a new cgroup with the CPU quota, memory
+    and PID limits, and the usage is read from the cgroup. Otherwise, the memory and PID limits are applied with
+    prlimit and the usage is measured with wait4. The fallback is weaker: the memory limit is RLIMIT_DATA (heap and
+    private writable mappings of each process rather than the memory of the whole tree), the PID limit counts all the
+    processes and threads of the user, and no CPU quota is applied.
+    :return: a tuple of (return code, stdout, stderr, resource usage)
+    """
+    cgroup = None
+    if cgroup_root and cgroup_name and os.access(cgroup_root, os.W_OK):
+        cgroup = _Cgroup(cgroup_root, cgroup_name)
+        try:
+            cgroup.create(limits)
+        except OSError:
+            logger.warning('Failed to create cgroup %s, falling back to prlimit', cgroup.path, exc_info=True)
+            cgroup = None
+
+    try:
+        # the command gets /dev/null as stdin once released
+        gated_args = ['sh', '-c', 'read _; exec "$@" < /dev/null', 'sh'] + list(args)
+        proc = subprocess.Popen(gated_args, cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            if cgroup is not None:
+                try:
+                    cgroup.add(proc.pid)
+                except OSError:
+                    logger.warning('Failed to move the process into cgroup %s, falling back to prlimit', cgroup.path,
+                                   exc_info=True)
+                    cgroup.destroy()
+                    cgroup = None
+            if cgroup is None:
+                if limits.memory is not None:
+                    _set_rlimit(proc.pid, resource.RLIMIT_DATA, limits.memory * 1024 * 1024)
+                if limits.pids is not None:
+                    _set_rlimit(proc.pid, resource.RLIMIT_NPROC, limits.pids)
+            # release the command
+            proc.stdin.write(b'\n')
+            proc.stdin.close()
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+
+        stdout_chunks, stderr_chunks = [], []
+        readers = [threading.Thread(target=_read_pipe, args=(proc.stdout, stdout_chunks)),
+                   threading.Thread(target=_read_pipe, args=(proc.stderr, stderr_chunks))]
+        for reader in readers:
+            reader.start()
+
+        # use wait4 instead of Popen.wait to get the resource usage of this process tree only
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+        # kill the remaining processes in the group, e.g. background jobs that keep the pipes open
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        for reader in readers:
+            reader.join()
+
+        if cgroup is not None:
+            usage = cgroup.get_usage()
+        else:
+            usage = {
+                'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+                'peak_memory_bytes': rusage.ru_maxrss * 1024,
+                'io_read_bytes': rusage.ru_inblock * 512,
+                'io_write_bytes': rusage.ru_oublock * 512
+            }
+        usage['cgroup'] = cgroup is not None
+        return proc.returncode, b''.join(stdout_chunks), b''.join(stderr_chunks), usage
+    finally:
+        if cgroup is not None:
+            cgroup.destroy()
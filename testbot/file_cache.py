@@ -0,0 +1,166 @@
+import fcntl
+import os
+import shutil
+import stat
+import threading
+import time
+
+from testbot.api import download_submission_file
+from testbot.configs import config, data_folder
+from testbot.util import md5sum
+
+
+class SubmissionFileCache:
+    """
+    Content-addressed store of the submission files keyed by md5, so the same file is downloaded only once for all the
+    test configs of a submission. The least recently used files are evicted when the total size exceeds the limit.
+
+    The cached files are read-only. They are hard-linked into the work folders of the executors that only read the
+    submission files, and copied (writable) for the others.
+
+    The total size is tracked in memory and the store is only scanned again when the tracked size exceeds the limit,
+    or when the last scan is older than `_RESCAN_INTERVAL` to count the files added by the other worker processes.
+    """
+    _RESCAN_INTERVAL = 300  # seconds
+
+    def __init__(self, folder: str, max_size: int):
+        """
+        :param folder: folder of the store
+        :param max_size: max total size of the files in MB
+        """
+        self.folder = folder
+        self.max_size = max_size * 1024 * 1024
+        self._lock = threading.Lock()
+        self._size = None  # total size at the last scan plus the files added since then
+        self._scan_time = 0
+
+    def _get_path(self, md5: str) -> str:
+        return os.path.join(self.folder, md5[:2], md5)
+
+    @staticmethod
+    def _link(src: str, dst: str, hard_link: bool):
+        if hard_link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:  # e.g. cross-device link to tmpfs
+                pass
+        shutil.copyfile(src, dst)
+
+    def get_size(self, md5: str):
+        """
+        :return: size of the cached file in bytes, or None if it is not cached
+        """
+        try:
+            return os.path.getsize(self._get_path(md5))
+        except OSError:
+            return None
+
+    def get(self, md5: str, local_save_path: str, hard_link: bool = False) -> bool:
+        """
+        Put the cached file into the target path
+        :param hard_link: whether the file can be hard-linked (read-only) instead of copied
+        :return: True if the file is found in the cache
+        """
+        path = self._get_path(md5)
+        if not os.path.isfile(path):
+            return False
+        # the file may have been changed through a hard link in a work folder
+        if md5sum(path) != md5:
+            os.remove(path)
+            return False
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # evicted by another process
+            return False
+        self._link(path, local_save_path, hard_link)
+        return True
+
+    def download(self, submission_id: int, work_id: str, file: dict, local_save_path: str, hard_link: bool = False):
+        """
+        Get the submission file from the cache, or download it into the cache first
+        :param hard_link: whether the file can be hard-linked (read-only) instead of copied
+        """
+        md5 = file['md5']
+        if self.get(md5, local_save_path, hard_link):
+            return
+
+        path = self._get_path(md5)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = path + '.part'
+        size = None
+        # the partial file is kept for resuming after a failure, and locked to avoid concurrent downloads by the other
+        # threads and processes
+        with open(part_path, 'ab') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.isfile(path):  # may have been downloaded by another thread or process
+                    download_submission_file(submission_id, work_id, file, path)
+                    os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)  # read-only for all the hard links
+                    size = os.path.getsize(path)
+                else:
+                    try:
+                        os.remove(part_path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+        self._link(path, local_save_path, hard_link)
+        if size is not None:
+            self._track(size)
+
+    def _track(self, size: int):
+        """
+        Count a newly added file, and evict files if the store may have grown past the limit
+        """
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size and time.time() - self._scan_time < self._RESCAN_INTERVAL:
+                    return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until the total size is within the limit
+        """
+        files = []
+        total_size = 0
+        for dir_path, _, file_names in os.walk(self.folder):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                # skip the temp files being downloaded
+                if '.' in name and time.time() - st.st_mtime < 3600:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        with self._lock:
+            self._size = total_size
+            self._scan_time = time.time()
+
+
+_submission_file_cache = None
+
+
+def get_submission_file_cache():
+    global _submission_file_cache
+    cache_config = config.get('SUBMISSION_FILE_CACHE')
+    if not cache_config:
+        return None
+    if _submission_file_cache is None:
+        _submission_file_cache = SubmissionFileCache(os.path.join(data_folder, 'submission_files'),
+                                                     cache_config.get('max_size', 1024))
+    return _submission_file_cache
@@ -0,0 +1,152 @@
+import zlib
+
+from kombu import Queue
+
+from testbot.configs import config
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+_scheduling_config = config.get('SCHEDULING') or {}
+enabled = bool(_scheduling_config)
+tenant_shards = _scheduling_config.get('tenant_shards', 4)
+max_priority = _scheduling_config.get('max_priority', 9)
+tenant_weights = _scheduling_config.get('tenant_weights') or {}
+default_priorities = {
+    LANE_INTERACTIVE: _scheduling_config.get('interactive_priority', max_priority),
+    LANE_BULK: _scheduling_config.get('bulk_priority', 0)
+}
+
+
+def get_base_queue(queue: str) -> str:
+    """
+    Get the base queue of a lane queue, e.g. 'testbot_env_test_docker.bulk.2' -> 'testbot_env_test_docker'
+    """
+    return queue.split('.', 1)[0]
+
+
+def get_lane_queues(base_queue: str, lane: str) -> list:
+    return ['%s.%s.%d' % (base_queue, lane, shard) for shard in range(tenant_shards)]
+
+
+def get_task_queues(base_queues) -> list:
+    """
+    Declare the base queues (without priority, for compatibility with the existing ones) and the lane queues of each
+    tenant shard (with priority support)
+    """
+    queues = []
+    for base_queue in base_queues:
+        queues.append(Queue(base_queue))
+        for lane in LANES:
+            for queue in get_lane_queues(base_queue, lane):
+                queues.append(Queue(queue, queue_arguments={'x-max-priority': max_priority}))
+    return queues
+
+
+def _get_tenant_weight(tenant: str) -> int:
+    return min(max(int(tenant_weights.get(tenant, 1)), 1), tenant_shards)
+
+
+def get_tenant_shard(tenant: str, submission_id: int) -> int:
+    """
+    Map a tenant to a shard of the lane. Workers consume the shard queues in turn, so tenants in different shards get
+    fair shares. A tenant with weight w is spread over w shards.
+    """
+    return (zlib.crc32(tenant.encode()) + submission_id % _get_tenant_weight(tenant)) % tenant_shards
+
+
+def get_shard_mapping(tenants) -> dict:
+    """
+    Get the shards of each tenant, to find the tenants sharing a shard (which block each other)
+    :param tenants: tenant keys
+    :return: dict of shard -> sorted list of tenants in the shard
+    """
+    mapping = {shard: [] for shard in range(tenant_shards)}
+    for tenant in tenants:
+        tenant = str(tenant)
+        shards = {get_tenant_shard(tenant, i) for i in range(_get_tenant_weight(tenant))}
+        for shard in shards:
+            mapping[shard].append(tenant)
+    return {shard: sorted(shard_tenants) for shard, shard_tenants in mapping.items()}
+
+
+class TaskEntry:
+    """
+    Entry of a task for the master server. Behaves like the Celery task itself, with an extra `submit` method to send
+    the task to a lane with a priority and a tenant key.
+    """
+
+    def __init__(self, task, base_queue: str):
+        self.task = task
+        self.base_queue = base_queue
+
+    def __getattr__(self, item):
+        return getattr(self.task, item)
+
+    def __call__(self, *args, **kwargs):
+        return self.task(*args, **kwargs)
+
+    def submit(self, submission_id: int, test_config_id: int, priority: int = None, tenant=None, bulk: bool = False,
+               **options):
+        """
+        Send the task
+        :param submission_id: id of the submission
+        :param test_config_id: id of the test config
+        :param priority: priority within the lane, from 0 (lowest) to `max_priority` (highest)
+        :param tenant: tenant key for fair scheduling, e.g. course id or test config id
+        :param bulk: send to the bulk lane (re-runs) instead of the interactive lane (single submissions)
+        :param options: other options for `apply_async`
+        :return: AsyncResult of the task
+        """
+        args = (submission_id, test_config_id)
+        if not enabled:
+            return self.task.apply_async(args, **options)
+
+        lane = LANE_BULK if bulk else LANE_INTERACTIVE
+        if tenant is None:
+            tenant = test_config_id
+        return self.task.apply_async(args, **self._get_lane_options(lane, priority, tenant, submission_id), **options)
+
+    def _get_lane_options(self, lane: str, priority, tenant, shard_key: int) -> dict:
+        if priority is None:
+            priority = default_priorities[lane]
+        priority = min(max(priority, 0), max_priority)
+        queue = get_lane_queues(self.base_queue, lane)[get_tenant_shard(str(tenant), shard_key)]
+        return {'queue': queue, 'priority': priority}
+
+
+class BatchTaskEntry(TaskEntry):
+    """
+    Entry of a batch task for the master server. Batch tasks are re-runs of many submissions, so they are always sent
+    to the bulk lane.
+    """
+
+    def submit(self, test_config_id: int, submission_ids: list, work_ids: list = None, parallelism: int = None,
+               priority: int = None, tenant=None, **options):
+        """
+        Send the task
+        :param test_config_id: id of the test config
+        :param submission_ids: ids of the submissions
+        :param work_ids: ids of the work of each submission in the submission system
+        :param parallelism: max number of submissions tested at the same time
+        :param priority: priority within the bulk lane, from 0 (lowest) to `max_priority` (highest)
+        :param tenant: tenant key for fair scheduling, which is the test config id by default
+        :param options: other options for `apply_async`
+        :return: AsyncResult of the task
+        """
+        args = (test_config_id, submission_ids, work_ids, parallelism)
+        if not enabled:
+            return self.task.apply_async(args, **options)
+
+        if tenant is None:
+            tenant = test_config_id
+        shard_key = submission_ids[0] if submission_ids else 0
+        return self.task.apply_async(args, **self._get_lane_options(LANE_BULK, priority, tenant, shard_key), **options)
+
+
+if __name__ == '__main__':
+    # print the shard mapping of the given tenants, e.g. `python -m testbot.scheduling 12 15 20`
+    import sys
+    for _shard, _tenants in get_shard_mapping(sys.argv[1:]).items():
+        print('%d: %s%s' % (_shard, ', '.join(_tenants), ' (shared)' if len(_tenants) > 1 else ''))
@@ -1,22 +1,73 @@
 import celery
 
-from testbot.api import report_result
+from testbot.configs import config
+
+
+def get_success_report(result) -> dict:
+    return {
+        'final_state': 'SUCCESS',
+        'result': result
+    }
+
+
+def get_failure_report(exc: BaseException, traceback: str) -> dict:
+    # keep the end of a long traceback, which is the most relevant part
+    max_traceback_size = (config.get('RESULT') or {}).get('max_traceback_size')
+    if traceback and max_traceback_size is not None and len(traceback) > max_traceback_size:
+        traceback = '...(truncated)\n' + traceback[-max_traceback_size:]
+    return {
+        'final_state': 'FAILURE',
+        'exception_class': type(exc).__name__,
+        'exception_message': str(exc),
+        'exception_traceback': traceback
+    }
+
+
+def get_retry_policy(retries: int) -> tuple:
+    """
+    Get the retry policy of a task that failed due to a transient API error from `API` in the config
+    :param retries: number of retries so far
+    :return: a tuple of (max number of retries, countdown of the next retry in seconds)
+    """
+    api_config = config.get('API') or {}
+    return api_config.get('task_retries', 3), min(api_config.get('task_retry_backoff', 10) * (2 ** retries), 600)
 
 
 # noinspection PyAbstractClass
 class BotTask(celery.Task):
+    def _report_result(self, work_id, submission_id: int, report: dict):
+        from testbot.api import report_result  # lazy import to keep worker startup fast
+        from testbot.tracing import create_tracer
+        tracer = create_tracer(work_id, submission_id=submission_id)
+        try:
+            with tracer.span('api.report_result', final_state=report['final_state']):
+                report_result(submission_id, work_id, report)
+        finally:
+            tracer.export()
+
     def on_success(self, result, work_id, args, kwargs):
         submission_id = args[0]
-        report_result(submission_id, work_id, {
-            'final_state': 'SUCCESS',
-            'result': result
-        })
+        self._report_result(work_id, submission_id, get_success_report(result))
 
     def on_failure(self, exc, work_id, args, kwargs, exc_info):
         submission_id = args[0]
-        report_result(submission_id, work_id, {
-            'final_state': 'FAILURE',
-            'exception_class': type(exc).__name__,
-            'exception_message': str(exc),
-            'exception_traceback': exc_info.traceback
-        })
+        self._report_result(work_id, submission_id, get_failure_report(exc, exc_info.traceback))
+
+
+# noinspection PyAbstractClass
+class BatchBotTask(celery.Task):
+    """
+    Task that runs the tests of many submissions, where the result of each submission is reported by the task itself
+    """
+    pass
+
+
+# noinspection PyAbstractClass
+class AsyncBotTask(BotTask):
+    """
+    Task that hands its executor to the shared event loop and returns at once, where the result is reported by the
+    executor when it finishes. A failure to hand it over is still reported by the task.
+    """
+
+    def on_success(self, result, work_id, args, kwargs):
+        pass
@@ -0,0 +1,186 @@
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from testbot.configs import config, data_folder
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class JsonLinesExporter:
+    """
+    Append the spans to a local file, one JSON object per line
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list):
+        lines = ''.join(json.dumps(span.to_dict()) + '\n' for span in spans)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # the file is shared by the worker processes
+            try:
+                f.write(lines)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class OTLPHttpExporter:
+    """
+    Send the spans to an OpenTelemetry collector with OTLP/HTTP in JSON encoding
+    """
+
+    def __init__(self, endpoint: str, headers: dict = None, service_name: str = 'submit-testbot', timeout: int = 5):
+        self.endpoint = endpoint
+        self.headers = headers or {}
+        self.service_name = service_name
+        self.timeout = timeout
+
+    @staticmethod
+    def _to_otlp_value(value) -> dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def _to_otlp_span(self, span: Span) -> dict:
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(int(span.start_time * 1e9)),
+            'endTimeUnixNano': str(int((span.end_time or span.start_time) * 1e9)),
+            'attributes': [{'key': k, 'value': self._to_otlp_value(v)} for k, v in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: list):
+        import requests
+
+        data = {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]
+                },
+                'scopeSpans': [{
+                    'scope': {'name': 'testbot'},
+                    'spans': [self._to_otlp_span(span) for span in spans]
+                }]
+            }]
+        }
+        resp = requests.post(self.endpoint, json=data, headers=self.headers, timeout=self.timeout)
+        resp.raise_for_status()
+
+
+class Tracer:
+    """
+    Record the spans of the stages of a task, correlated by the Celery task id
+    """
+
+    def __init__(self, task_id: str, exporters: list = None, attributes: dict = None):
+        try:
+            self.trace_id = uuid.UUID(task_id).hex
+        except (TypeError, ValueError):
+            self.trace_id = uuid.uuid4().hex
+        self.task_id = task_id
+        self.exporters = exporters or []
+        self.attributes = attributes or {}
+        self.spans = []
+        self._stack = []
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent_id = self._stack[-1].span_id if self._stack else None
+        span = Span(name, self.trace_id, parent_id, dict(self.attributes, **attributes))
+        span.attributes['celery.task_id'] = self.task_id
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            span.end_time = time.time()
+            self._stack.pop()
+
+    def summary(self) -> dict:
+        """
+        Get a summary of the spans so far, i.e. name, duration (seconds) and depth of each span in order. The duration
+        of a span still running (e.g. the whole task) is the time elapsed since it started.
+        """
+        depths = {}
+        stages = []
+        for span in self.spans:
+            depth = depths.get(span.parent_id, -1) + 1
+            depths[span.span_id] = depth
+            stages.append({'name': span.name, 'duration': round(span.duration, 6), 'depth': depth,
+                           'running': span.end_time is None, 'error': span.error})
+        return {'trace_id': self.trace_id, 'task_id': self.task_id, 'stages': stages}
+
+    def export(self):
+        spans = [span for span in self.spans if span.end_time is not None]
+        if not spans:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception:
+                # tracing must not fail the task
+                logger.exception('Failed to export spans with %s', type(exporter).__name__)
+
+
+def get_tracing_config() -> dict:
+    return config.get('TRACING') or {}
+
+
+def create_tracer(task_id: str, **attributes) -> Tracer:
+    tracing_config = get_tracing_config()
+    exporters = []
+    path = tracing_config.get('path')
+    if path:
+        exporters.append(JsonLinesExporter(os.path.join(data_folder, path)))
+    otlp_endpoint = tracing_config.get('otlp_endpoint')
+    if otlp_endpoint:
+        exporters.append(OTLPHttpExporter(otlp_endpoint, tracing_config.get('otlp_headers')))
+    return Tracer(task_id, exporters, attributes)